@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+import pandas as pd
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+EXTRACT_PATH = os.path.join(BENCHMARK_PATH, "..", "extract_data")
+TRANSFORM_PATH = os.path.join(BENCHMARK_PATH, "..", "transform_load_data")
+# BEA publishes ~3,100 counties in its county (CA*) tables
+COUNTIES = 3100
+# the stub accepts any key of the length beaapi checks for
+STUB_KEY = "00000000-0000-0000-0000-000000000000"
+
+
+def cpu_seconds():
+    # this process plus reaped children (the transform pool)
+    return sum(r.ru_utime + r.ru_stime for r in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+class stage_timer():
+    """
+    Wall time, CPU time, rows, throughput and peak RSS per pipeline stage.
+    Peak RSS is the process high water mark when the stage finished, so a stage only raises it.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, stage, fn, *args):
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        result, rows = fn(*args)
+        wall, cpu = time.perf_counter() - wall, cpu_seconds() - cpu
+        self.stages[stage] = {"seconds": round(wall, 4),
+                              "cpu_seconds": round(cpu, 4),
+                              "cpu_utilization": round(cpu / wall, 2) if wall else None,
+                              "rows": rows,
+                              "rows_per_second": round(rows / wall) if wall else None,
+                              "peak_rss_mb": round(peak_rss_mb(), 1),
+                              "peak_child_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)}
+        print(f"{stage:<10} {rows:>10} rows {wall:>8.2f}s wall {cpu:>8.2f}s cpu {self.stages[stage]['peak_rss_mb']:>7.0f} MB peak")
+        return result
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(args):
+    """
+    Run bea_stub_server in its own process so its CPU is not charged to the fetch stage
+    """
+    port = free_port()
+    stub = subprocess.Popen([sys.executable, "bea_stub_server.py", "--port", str(port),
+                             "--counties", str(args.counties), "--line-codes", str(args.line_codes),
+                             "--start-year", str(args.end_year - args.years + 1), "--end-year", str(args.end_year)],
+                            cwd=EXTRACT_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return stub, f"http://127.0.0.1:{port}/api/data/"
+        except OSError:
+            time.sleep(0.1)
+    stub.kill()
+    raise RuntimeError("bea_stub_server did not start")
+
+
+def fetch(api):
+    results = api.collect_data()
+    return results, sum(len(df) for data_dict in results for df in data_dict.values())
+
+
+def state_filter(bea_clean, api, results):
+    tables = {}
+    for table, data_dict in zip(api.table_dict, results):
+        tables[api.table_names[table]] = [bea_clean.filter_states(df) for df in data_dict.values()]
+    return tables, sum(len(df) for frames in tables.values() for df in frames)
+
+
+def stage_write(staging, tables):
+    paths = {}
+    for table, frames in tables.items():
+        writer = staging.writer(table)
+        for df in frames:
+            writer.write(df)
+        paths[table] = writer.close()
+    return paths, sum(len(df) for frames in tables.values() for df in frames)
+
+
+def transform(bea_prep):
+    arrow_dict = bea_prep.transform()
+    return arrow_dict, sum(data.num_rows for data in arrow_dict.values())
+
+
+def load(loader, con, arrow_dict, aliases):
+    loader.create_tables(con)
+    loader.configure(con)
+    rows = {table_name: loader.merge(con, table_name, data) for table_name, data in arrow_dict.items()}
+    loader.upsert_aliases(con, aliases)
+    return rows, sum(rows.values())
+
+
+def validate(loader, con, tables):
+    report = loader.validate(con, tables)
+    return report, sum(result["rows"] for result in report["tables"].values())
+
+
+def views(con, materialize):
+    bea_db = beav.bea_views(con, materialize)
+    bea_db.refresh()
+    rows = sum(con.execute(f"select count(*) from {view_name}").fetchone()[0] for view_name in bea_db.view_queries)
+    return None, rows
+
+
+def cube(con):
+    return None, bea_cube(con).build()
+
+
+def county_projection(stages, staged_bytes, counties, target):
+    """
+    Scale each stage linearly in rows from this run's counties up to target counties.
+    Memory scales the stage's growth over the baseline, an upper bound for the batched (--batch-size) paths.
+    """
+    scale = target / counties
+    baseline = min(stage["peak_rss_mb"] for stage in stages.values())
+    projection = {"counties": target, "scale": round(scale, 2), "staged_mb": round(staged_bytes * scale / 1024 ** 2, 1), "stages": {}}
+    for name, stage in stages.items():
+        projection["stages"][name] = {"rows": round(stage["rows"] * scale),
+                                      "seconds": round(stage["seconds"] * scale, 2),
+                                      "peak_rss_mb": round(baseline + (stage["peak_rss_mb"] - baseline) * scale)}
+    projection["peak_rss_mb"] = max(stage["peak_rss_mb"] for stage in projection["stages"].values())
+    projection["seconds"] = round(sum(stage["seconds"] for stage in projection["stages"].values()), 2)
+    return projection
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage end to end against bea_stub_server with synthetic data")
+    parser.add_argument("--tables", nargs="+", default=["SAINC51", "CAINC4", "CAINC30", "SAGDP4N", "SAPCE2"],
+                        help="BEA table codes to run")
+    parser.add_argument("--line-codes", type=int, default=5, help="line codes per table")
+    parser.add_argument("--geography", choices=("STATE", "COUNTY"), default="STATE", help="COUNTY adds county rows for the CA* tables")
+    parser.add_argument("--counties", type=int, default=500, help="synthetic counties the stub serves for GeoFips=COUNTY")
+    parser.add_argument("--years", type=int, default=25)
+    parser.add_argument("--end-year", type=int, default=2022)
+    parser.add_argument("--staging-format", choices=("parquet", "feather", "json"), default="parquet")
+    parser.add_argument("--batch-size", type=int, help="transform and merge this many rows at a time")
+    parser.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 4GB")
+    parser.add_argument("--materialize", action="store_true", help="materialize the analysis views")
+    parser.add_argument("--project-counties", type=int, default=COUNTIES,
+                        help="counties to project COUNTY runs to")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    os.chdir(TRANSFORM_PATH)
+    sys.path[:0] = [EXTRACT_PATH, TRANSFORM_PATH]
+    import duckdb as db
+    import pyarrow as pa
+    import bea_views as beav
+    import bea_data_prep as prep
+    from bea_db_load import db_load
+    from bea_async import bea_api, rate_limiter
+    from bea_staging import bea_staging
+    from bea_data_json import bea_data_clean
+    from bea_catalog import bea_catalog
+    from bea_cube import bea_cube
+    from bea_metrics import peak_rss_mb
+
+    work_path = tempfile.mkdtemp(prefix="bea_benchmark_")
+    data_path = os.path.join(work_path, "data")
+    os.makedirs(data_path)
+    stub, url = start_stub(args)
+    timer = stage_timer()
+    try:
+        # no cache and no quota, so fetch measures the client against a local server
+        # a fresh catalog refreshes from the stub, which only serves --line-codes per table
+        api = bea_api(STUB_KEY, base_url=url, limiter=rate_limiter(10 ** 6, 10 ** 12, 10 ** 6), geography=args.geography,
+                      catalog=bea_catalog(os.path.join(work_path, "linecodes.csv")))
+        api.table_dict = {table: api.table_dict[table] for table in args.tables}
+        results = timer.run("fetch", fetch, api)
+
+        bea_clean = bea_data_clean(None, staging_format=args.staging_format, geography=args.geography)
+        tables = timer.run("filter", state_filter, bea_clean, api, results)
+        del results
+
+        paths = timer.run("stage", stage_write, bea_staging(data_path, args.staging_format), tables)
+        staged_bytes = sum(os.path.getsize(path) for path in paths.values())
+        del tables
+
+        arrow_dict = timer.run("transform", transform, prep.bea_data_prep(args.staging_format, data_path, args.batch_size))
+
+        db_path = os.path.join(work_path, "bureau_economic_analysis.db")
+        loader = db_load(export_format="none", materialize=args.materialize, db_path=db_path, arrow_dict=arrow_dict,
+                         batch_size=args.batch_size, memory_limit=args.memory_limit, quality_report=None)
+        con = db.connect(db_path)
+        timer.run("load", load, loader, con, arrow_dict, api.series_aliases())
+        timer.run("validate", validate, loader, con, list(arrow_dict))
+        timer.run("views", views, con, args.materialize)
+        timer.run("cube", cube, con)
+        con.close()
+        db_bytes = os.path.getsize(db_path)
+    finally:
+        stub.terminate()
+        stub.wait()
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    total = sum(stage["seconds"] for stage in timer.stages.values())
+    print(f"{'total':<10} {'':>15} {total:>8.2f}s wall")
+    report = {"config": vars(args),
+              "environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "cores": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+                              "pandas": pd.__version__,
+                              "pyarrow": pa.__version__,
+                              "duckdb": db.__version__},
+              "stages": timer.stages,
+              "seconds": round(total, 4),
+              "staged_mb": round(staged_bytes / 1024 ** 2, 2),
+              "db_mb": round(db_bytes / 1024 ** 2, 2)}
+    if args.geography == "COUNTY":
+        projection = report["projection"] = county_projection(timer.stages, staged_bytes, args.counties, args.project_counties)
+        print(f"Projected to {projection['counties']} counties: {projection['seconds']:.0f}s, {projection['peak_rss_mb']} MB peak RSS, {projection['staged_mb']} MB staged")
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+TRANSFORM_PATH = os.path.join(BENCHMARK_PATH, "..", "transform_load_data")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def workload(query, requests, distinct=500, seed=0):
+    """
+    requests (route, params) lookups drawn from distinct random series, yoy and ranking lookups over the states,
+    topics and years in the database. Popularity is Zipf-like, as with dashboards asking for the same few series.
+    """
+    rng = random.Random(seed)
+    states = query.states()
+    topics = {table: query.topics(table) for table in query.pool.tables}
+    topics = {table: table_topics for table, table_topics in topics.items() if table_topics}
+    years = [row["year"] for row in query.series(*next((table, states[0], table_topics[0]) for table, table_topics in topics.items()))]
+    categories = {view: [row[0] for row in query.pool.con.execute(f"select distinct {category} from {view}").fetchall()]
+                  for view, (category, _, _) in beq.RANKINGS.items() if view in query.pool.rankings}
+    lookups = []
+    for _ in range(distinct):
+        route = rng.choice(("series", "yoy", "ranking") if categories else ("series", "yoy"))
+        if route == "ranking":
+            view = rng.choice(sorted(categories))
+            lookups.append((route, {"view": view, "year": rng.choice(years[1:] or years), "category": rng.choice(categories[view])}))
+        else:
+            table = rng.choice(sorted(topics))
+            start_year = rng.choice(years)
+            lookups.append((route, {"table": table, "state": rng.choice(states), "topic": rng.choice(topics[table]),
+                                    "start_year": start_year, "end_year": min(start_year + 10, years[-1])}))
+    return rng.choices(lookups, weights=[1 / rank for rank in range(1, len(lookups) + 1)], k=requests)
+
+
+def call(query, route, params):
+    if route == "ranking":
+        return query.ranking(params["view"], params["year"], params["category"])
+    return getattr(query, route)(params["table"], params["state"], params["topic"], params["start_year"], params["end_year"])
+
+
+def run_library(query, lookups, clients):
+    """
+    clients threads calling bea_query directly. Returns per request latencies in seconds and the wall time.
+    """
+    def timed(lookup):
+        start = time.perf_counter()
+        call(query, *lookup)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(timed, lookups))
+    return latencies, time.perf_counter() - start
+
+
+async def run_http(url, lookups, clients):
+    """
+    clients concurrent HTTP clients against bea_query.py. Returns per request latencies in seconds and the wall time.
+    """
+    import aiohttp
+    pending = iter(lookups)
+    latencies = []
+
+    async def client(session):
+        for route, params in pending:
+            start = time.perf_counter()
+            async with session.get(f"{url}/{route}", params={k: str(v) for k, v in params.items()}) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"{route} {params}: HTTP {response.status}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=clients)) as session:
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+    return latencies, time.perf_counter() - start
+
+
+def start_server(args, cache_size):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "bea_query.py", "--db-path", os.path.abspath(args.db_path), "--port", str(port),
+                               "--pool-size", str(args.pool_size), "--cache-size", str(cache_size), "--log-file", os.devnull],
+                              cwd=TRANSFORM_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("bea_query.py did not start")
+
+
+def summary(latencies, wall):
+    ms = sorted(latency * 1000 for latency in latencies)
+    quantiles = statistics.quantiles(ms, n=100, method="inclusive")
+    return {"requests": len(ms),
+            "seconds": round(wall, 4),
+            "requests_per_second": round(len(ms) / wall),
+            "p50_ms": round(quantiles[49], 3),
+            "p95_ms": round(quantiles[94], 3),
+            "p99_ms": round(quantiles[98], 3),
+            "max_ms": round(ms[-1], 3)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test bea_query lookups with concurrent clients, reporting p50/p99 latency")
+    parser.add_argument("--db-path", default=os.path.join(TRANSFORM_PATH, "bureau_economic_analysis.db"))
+    parser.add_argument("--mode", choices=("library", "http"), default="library",
+                        help="call bea_query in process, or over HTTP against bea_query.py")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--distinct", type=int, default=500, help="distinct lookups the requests are drawn from")
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--cache-size", type=int, default=4096, help="LRU size of the cached run, the uncached run uses 0")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    sys.path[:0] = [TRANSFORM_PATH]
+    import duckdb as db
+    import bea_query as beq
+    from bea_metrics import metrics
+    metrics.configure(os.devnull)
+
+    probe = beq.bea_query(args.db_path, pool_size=1, cache_size=0)
+    lookups = workload(probe, args.requests, args.distinct)
+    probe.close()
+
+    results = {}
+    for run, cache_size in (("uncached", 0), ("cached", args.cache_size)):
+        if args.mode == "library":
+            query = beq.bea_query(args.db_path, args.pool_size, cache_size)
+            latencies, wall = run_library(query, lookups, args.clients)
+            stats = query.stats()
+            query.close()
+        else:
+            server, url = start_server(args, cache_size)
+            try:
+                latencies, wall = asyncio.run(run_http(url, lookups, args.clients))
+            finally:
+                server.terminate()
+                server.wait()
+            stats = {}
+        results[run] = {**summary(latencies, wall), **{key: stats[key] for key in ("cache_hits", "cache_misses") if key in stats}}
+        result = results[run]
+        print(f"{run:<9} {result['requests']:>6} requests {result['requests_per_second']:>7} req/s "
+              f"p50 {result['p50_ms']:>7.2f} ms p99 {result['p99_ms']:>7.2f} ms max {result['max_ms']:>7.2f} ms")
+
+    report = {"config": vars(args),
+              "environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "cores": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+                              "duckdb": db.__version__},
+              "runs": results}
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
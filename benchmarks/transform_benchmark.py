@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import argparse
+import pandas as pd
+import pyarrow as pa
+from collections import defaultdict
+
+TRANSFORM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "transform_load_data")
+
+
+def baseline_prep(prep):
+    """
+    bea_data_prep with the pandas transform it had before the Arrow compute rewrite: a per row GeoName apply,
+    a defaultdict code split and per table regex descriptions, merged onto the data. Kept to reproduce the before/after comparison.
+    """
+    class pandas_prep(prep.bea_data_prep):
+        def clean_staged_table(self, table):
+            data_dict = {}
+            data_df = self.bea_dataframe(self.staging.read(table).to_pandas())
+            data_dict[table] = self.clean_table(table, data_df)
+            return data_dict
+
+        def clean_table(self, table, data_df):
+            clean_endpoints_df = self.clean_endpoints(data_df)
+            description_df = self.table_description(table, clean_endpoints_df)
+            endpoints_description_df = clean_endpoints_df.merge(description_df[["endpoint", "table", "topic"]],
+                                                                how="inner",
+                                                                on=["table", "endpoint"]).drop_duplicates().reset_index(drop=True)
+            data_endpoints_df = data_df.merge(endpoints_description_df, how="inner", on="code")
+            return pa.Table.from_pandas(data_endpoints_df, preserve_index=False)
+
+        def bea_dataframe(self, json_df):
+            json_df["GeoName"] = json_df["GeoName"].apply(lambda x: "United States" if x == "United States *" else x)
+            json_df.columns = map(str.lower, json_df.columns)
+            return json_df
+
+        def clean_endpoints(self, df):
+            code_dict = defaultdict(lambda: defaultdict(str))
+            for code in df.code.unique():
+                code_components = code.split("-")
+                code_dict[code]["table"] = code_components[0]
+                code_dict[code]["endpoint"] = code_components[1]
+            return pd.DataFrame(code_dict).T.reset_index(names="code")
+
+        def table_description(self, table, description_df):
+            endpoint_re_map = {
+                "compensation": (["Compensation of employees: ", r" \(\d.+\)$"], ["", ""]),
+                "real_gdp": (["Real GDP: ", r" \(\d.+\)$"], ["", ""]),
+                "gdp": ([r"Gross domestic product \(GDP\) by state\: ", r" \(\d.+\)$"], ["", ""]),
+                "consumption_expenditure": (["Per capita personal consumption expenditures: "], ["", ""])
+            }
+            if self.endpoints_df is None:
+                self.endpoints_df = self.endpoints_file()
+            endpoints_description = self.endpoints_df[self.endpoints_df.table.isin(description_df.table.unique())]
+            if table in endpoint_re_map:
+                endpoint_re = endpoint_re_map[table]
+                endpoints_description["topic"] = endpoints_description.desc.replace(endpoint_re[0], endpoint_re[1], regex=True)
+            else:
+                endpoints_description["topic"] = endpoints_description["desc"]
+            return endpoints_description
+
+    return pandas_prep
+
+
+def time_tables(bea_prep, tables, repeat):
+    """
+    Best of repeat wall times for bea_data_prep.clean_staged_table, per table
+    """
+    timings = {}
+    for table in tables:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = bea_prep.clean_staged_table(table)
+            runs.append(time.perf_counter() - start)
+        timings[table] = {"seconds": min(runs), "rows": result[table].num_rows}
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the per table transform in bea_data_prep")
+    parser.add_argument("--staging-format", choices=("parquet", "feather", "json"), default="parquet")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", action="store_true", help="time the pandas transform from before the Arrow compute rewrite")
+    parser.add_argument("--output", help="write timings as JSON to this file")
+    args = parser.parse_args()
+
+    os.chdir(TRANSFORM_PATH)
+    sys.path.append(TRANSFORM_PATH)
+    import bea_data_prep as prep
+
+    prep_class = baseline_prep(prep) if args.baseline else prep.bea_data_prep
+    bea_prep = prep_class(args.staging_format)
+    timings = time_tables(bea_prep, bea_prep.find_staged_tables(), args.repeat)
+    for table, timing in timings.items():
+        print(f"{table:<28} {timing['rows']:>8} rows {1000 * timing['seconds']:>9.1f} ms")
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(timings, outfile, indent=2)
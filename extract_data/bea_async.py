@@ -1,95 +1,346 @@
 import beaapi as bea
-import re
+import json
+import time
+import random
 import asyncio
 import aiohttp
-from functools import lru_cache
+import pandas as pd
 
-class bea_api(): 
-    def __init__(self, api_key): 
-        """ 
+from bea_metrics import metrics
+from bea_catalog import bea_catalog
+from bea_tables import TABLE_DESCRIPTIONS, TABLE_NAMES
+
+BEA_URL = "https://apps.bea.gov/api/data/"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class bea_retry_error(Exception):
+    """
+    Raised for responses worth retrying (rate limited or server side failures).
+    """
+    def __init__(self, status, message=""):
+        super().__init__(f"BEA API returned status {status} {message}".strip())
+        self.status = status
+
+
+class rate_limiter():
+    """
+    Token buckets for BEA's per-minute quotas: requests, response volume and errors.
+    Buckets refill continuously, so bursts up to the full quota are allowed and then requests are spaced out.
+    Response sizes are only known after a request lands, so volume is charged afterwards and can go into debt.
+    """
+    def __init__(self, requests_per_minute=bea.MAX_REQUESTS_PER_MINUTE - 1,
+                 bytes_per_minute=bea.MAX_DATA_PER_MINUTE,
+                 errors_per_minute=bea.MAX_ERRORS_PER_MINUTE - 1):
+        self.capacity = {"requests": requests_per_minute, "bytes": bytes_per_minute, "errors": errors_per_minute}
+        self.tokens = dict(self.capacity)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for bucket, capacity in self.capacity.items():
+            self.tokens[bucket] = min(capacity, self.tokens[bucket] + elapsed * capacity / 60)
+
+    def wait_time(self):
+        """
+        Seconds until one request, some volume and one error are all available.
+        """
+        waits = [0]
+        if self.tokens["requests"] < 1:
+            waits.append((1 - self.tokens["requests"]) * 60 / self.capacity["requests"])
+        if self.tokens["bytes"] <= 0:
+            waits.append(-self.tokens["bytes"] * 60 / self.capacity["bytes"])
+        if self.tokens["errors"] < 1:
+            waits.append((1 - self.tokens["errors"]) * 60 / self.capacity["errors"])
+        return max(waits)
+
+    async def acquire(self):
+        """
+        Wait for a request token. The check and the take happen without yielding, so no lock is needed.
+        """
+        while True:
+            self.refill()
+            wait = self.wait_time()
+            if wait == 0:
+                self.tokens["requests"] -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def consume_bytes(self, size):
+        self.tokens["bytes"] -= size
+
+    def consume_error(self):
+        self.tokens["errors"] -= 1
+
+
+class bea_incomplete_error(Exception):
+    """
+    Raised after a checkpointed run when some line codes failed. Completed ones are kept in the checkpoint for --resume.
+    """
+    def __init__(self, failed):
+        super().__init__(f"{len(failed)} line codes failed: " + ", ".join(f"{code} ({error})" for code, error in failed[:10]))
+        self.failed = failed
+
+
+class bea_api():
+    def __init__(self, api_key, base_url=BEA_URL, max_concurrency=8, max_retries=5, backoff=1, limiter=None,
+                 cache=None, incremental=False, revision_window=3, geography="STATE", checkpoint=None, catalog=None):
+        """
         api_key = api key needed for census api
+        base_url = BEA API url, point this to a local stub server for testing
+        max_concurrency = cap on in flight GetData requests
+        max_retries = retries for 429/5xx responses and connection errors, with exponential backoff starting at backoff seconds
+        limiter = rate_limiter shared across requests, defaults to BEA's published quotas
+        cache = bea_cache for raw responses, needed for change detection and incremental runs
+        incremental = only request years after the last cached period plus the trailing revision_window years
+        geography = STATE, or COUNTY to also request county rows for the county (CA*) tables
+        checkpoint = bea_checkpoint persisting each line code as it lands. Line codes done earlier in a resumed run aren't
+            requested again, and failed line codes no longer abort the others (bea_incomplete_error is raised at the end)
+        catalog = bea_catalog of line codes, refreshed from GetParameterValues only when stale
         """
         self.key = api_key
-        self.table_dict = {"SAINC30": "Personal income", 
-                           "SAGDP4N": "Employee compensation", 
-                           "SAPCE2": "Personal consumption expenditures", 
-                           "SAINC51": "Disposable income", 
-                           "SAGDP2N": "GDP", 
-                           "CAGDP9": "Real GDP", 
-                           "CAINC1": "Population", 
-                           "CAINC30": "Wages", 
-                           "CAINC4": "Employment"}
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = limiter if limiter is not None else rate_limiter()
+        self.cache = cache
+        self.incremental = incremental
+        self.revision_window = revision_window
+        self.geography = geography
+        self.checkpoint = checkpoint
+        self.catalog = catalog if catalog is not None else bea_catalog()
+        self.changed_keys = set()
+        self.failed = []
+        # copies, so a run can be narrowed to some tables, see bea_tables
+        self.table_dict = dict(TABLE_DESCRIPTIONS)
+        self.table_names = dict(TABLE_NAMES)
+        self.on_result = None
 
     def param_vals(self, dataset, param):
-        return bea.get_parameter_values(self.key, datasetname=dataset, parametername=param)
+        specs = {"method": "GetParameterValues",
+                 "UserID": self.key,
+                 "datasetname": dataset,
+                 "ParameterName": param,
+                 "ResultFormat": "json",
+                 "base_url": self.base_url + "?"}
+        response = bea.api_request(specs, as_dict=True, as_table=False, is_meta=True)
+        return pd.DataFrame(response["ParamValue"], dtype="str")
 
-    @lru_cache
     def linecode_lookup(self):
         """
-        Line codes represent different linecode endpoints available from BEA.
+        Line codes represent different linecode endpoints available from BEA. Read from the catalog,
+        which only calls GetParameterValues when it is older than its TTL.
+        """
+        return self.catalog.load(lambda: self.param_vals("Regional", "LineCode"))
+
+    def response_table(self, payload):
+        """
+        Parse a GetData JSON payload into the same frame beaapi.get_data returns:
+        numeric dimensions converted, suppressed values ((NA), (D), (NM)) as missing.
+        """
+        response = json.loads(payload.decode("iso-8859-1"))["BEAAPI"]
+        results = response.get("Results", {})
+        error = response.get("Error") or results.get("Error")
+        if error:
+            raise bea.BEAAPIResponseError(json.dumps(error), len(payload))
+        data = results["Data"]
+        df = pd.DataFrame(data) if isinstance(data, list) else pd.DataFrame(data, index=[0])
+        numeric = [dim["Name"] for dim in results.get("Dimensions", []) if dim.get("DataType") == "numeric"]
+        for col in numeric:
+            if col == "DataValue":
+                df[col] = pd.to_numeric(df[col].str.replace(",", "").replace(["(NA)", "(D)", "(NM)"], ""), errors="coerce")
+            elif col in df.columns:
+                df[col] = pd.to_numeric(df[col])
+        if "NoteRef" in df.columns:
+            df["NoteRef"] = df["NoteRef"].fillna("")
+        return df
+
+    async def request_payload(self, session, params):
+        """
+        GET a raw payload. Requests are capped by the concurrency semaphore, paced by the rate limiter and retried with exponential backoff.
+        """
+        table = params["TableName"]
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire()
+                start = time.perf_counter()
+                status = None
+                try:
+                    async with session.get(self.base_url, params=params) as response:
+                        status = response.status
+                        payload = await response.read()
+                        self.limiter.consume_bytes(len(payload))
+                        self.record_request(params, attempt, status, time.perf_counter() - start, len(payload))
+                        if response.status in RETRY_STATUS:
+                            raise bea_retry_error(response.status)
+                        if response.status != 200:
+                            self.limiter.consume_error()
+                            response.raise_for_status()
+                        return payload
+                except (bea_retry_error, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    self.limiter.consume_error()
+                    if status is None:
+                        self.record_request(params, attempt, "error", time.perf_counter() - start, 0)
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+                    metrics.inc("bea_request_retries_total", table=table)
+                    metrics.event("request_retry", table=table, line_code=params["LineCode"], attempt=attempt + 1,
+                                  error=str(e), delay_seconds=round(delay, 2))
+                    await asyncio.sleep(delay)
+
+    def record_request(self, params, attempt, status, seconds, size):
+        table = params["TableName"]
+        metrics.observe("bea_request_seconds", seconds, table=table)
+        metrics.inc("bea_requests_total", table=table, status=status)
+        metrics.inc("bea_response_bytes_total", size, table=table)
+        metrics.event("request", table=table, line_code=params["LineCode"], geo_fips=params["GeoFips"], year=params["Year"],
+                      attempt=attempt, status=status, seconds=round(seconds, 4), bytes=size)
+
+    def geo_levels(self, table):
+        """
+        GeoFips levels to request for a table. State (SA*) tables only publish STATE, and a COUNTY request
+        returns counties without the US + state rows, so county runs request both.
         """
-        linecodes = self.param_vals("Regional", "LineCode")
-        linecodes["table"] = linecodes.Desc.apply(lambda x: re.search("(?<=\[).+(?=\])", x).group(0))
-        linecodes["Desc"] = linecodes.Desc.apply(lambda x: x.split("] ")[1])
-        return linecodes
+        if self.geography == "COUNTY" and table.startswith("CA"):
+            return ("STATE", "COUNTY")
+        return ("STATE",)
 
-    async def get_state_linecodes(self, table, line_code):
+    async def get_state_linecodes(self, session, table, line_code, geo_fips="STATE"):
         """
-        Call BEA API to get region wide data for the provided table and line code.
+        Call BEA API to get region wide data for the provided table, line code and GeoFips level.
+        With a cache, incremental runs only request recent years and merge them into the cached history.
+        Returns the data and whether it changed since the cached copy.
         """
-        return bea.get_data(self.key, datasetname="Regional", TableName=table, LineCode=line_code, GeoFips="STATE", year="ALL")
-    
+        params = {"UserID": self.key,
+                  "method": "GetData",
+                  "datasetname": "Regional",
+                  "TableName": table,
+                  "LineCode": line_code,
+                  "GeoFips": geo_fips,
+                  "Year": "ALL",
+                  "ResultFormat": "json"}
+        if self.cache is None:
+            return self.response_table(await self.request_payload(session, params)), True
+
+        cached = self.cache.get("Regional", table, line_code, geo_fips)
+        if self.incremental and cached is not None and cached["last_period"] is not None:
+            params["Year"] = self.cache.incremental_years(cached, self.revision_window)
+            payload = await self.request_payload(session, params)
+            self.response_table(payload) # raise API errors before merging
+            payload, changed = self.cache.merge("Regional", table, line_code, geo_fips, params["Year"], payload)
+            return self.response_table(payload), changed
+        payload = await self.request_payload(session, params)
+        data = self.response_table(payload)
+        return data, self.cache.put("Regional", table, line_code, geo_fips, "ALL", payload)
+
+    def series_aliases(self):
+        """
+        {alias: {alias_of, table, source_table}} for line codes publishing a series an earlier table in table_dict already
+        has (see bea_catalog.series_aliases). They are fetched and stored once, under the earlier table's line code.
+        """
+        self.linecode_lookup()
+        return {alias: {"alias_of": code, "table": self.table_names[alias.split("-")[0]], "source_table": self.table_names[code.split("-")[0]]}
+                for alias, code in self.catalog.series_aliases(self.table_dict).items()}
+
     def get_bea_keys(self, table):
         """
-        Collect all line codes for the given table. Some tables may require additional cleaning.
+        Collect the line codes of the given table once each, leaving out aliases of another table's line codes.
+        Some tables may require additional cleaning.
         """
-        linecodes = self.linecode_lookup()
-        keys = linecodes[(linecodes.table==table)].drop_duplicates()
+        self.linecode_lookup()
+        keys = self.catalog.table(table).drop_duplicates()
+        aliases = self.catalog.series_aliases(self.table_dict)
+        # a line code listed with two descriptions is still one request
+        keys = tuple(keys.Key.unique())
         if table == "SAGDP4N":
-            return tuple(k for k in keys.Key.unique() if not re.search("\(", k)) # get keys for industries with a parenthesis
-        else:
-            return tuple(keys.Key)
-        
-    async def get_bea_data(self, table, bea_session):
-        """
-        Aysnc calls for provided BEA table + linecode
-        """
-        disposable_income_keys = self.get_bea_keys(table) 
-        disposable_income_results = {}
-        async with bea_session as session:
-            print("Collecting BEA disposable income data")
-            for k in disposable_income_keys:
-                key_results = await self.get_state_linecodes(table, k)
-                disposable_income_results[f"{table}-{k}"] = key_results
-                print(f"{self.table_dict[table]} endpoint {k} found")
-            print(f"BEA {self.table_dict[table]} data collected")
-            print()
-            return disposable_income_results
+            keys = tuple(k for k in keys if "(" not in k) # get keys for industries with a parenthesis
+        metrics.inc("bea_linecodes_aliased_total", sum(f"{table}-{k}" in aliases for k in keys), table=table)
+        return tuple(k for k in keys if f"{table}-{k}" not in aliases)
+
+    async def get_linecode(self, session, table, key):
+        """
+        Fetch one line code. While streaming, a line code holds its slot until on_result has consumed it,
+        so responses can't pile up faster than they are loaded.
+        """
+        async with self.slots:
+            resumed = self.checkpoint.get(table, key) if self.checkpoint is not None else None
+            if resumed is not None:
+                key_results, changed = resumed
+                metrics.inc("bea_linecodes_resumed_total", table=table)
+            else:
+                try:
+                    levels = [await self.get_state_linecodes(session, table, key, geo_fips) for geo_fips in self.geo_levels(table)]
+                except Exception as e:
+                    if self.checkpoint is None:
+                        raise
+                    self.checkpoint.fail(table, key, e)
+                    self.failed.append((f"{table}-{key}", str(e)))
+                    metrics.inc("bea_linecodes_failed_total", table=table)
+                    metrics.event("linecode_failed", table=table, line_code=key, error=str(e))
+                    return f"{table}-{key}", None
+                key_results = levels[0][0] if len(levels) == 1 else pd.concat([data for data, _ in levels], ignore_index=True)
+                changed = any(level_changed for _, level_changed in levels)
+                if self.checkpoint is not None:
+                    self.checkpoint.put(table, key, key_results, changed)
+            if changed:
+                self.changed_keys.add(f"{table}-{key}")
+            metrics.inc("bea_linecodes_total", table=table, changed=changed)
+            metrics.event("linecode", table=table, line_code=key, rows=len(key_results), changed=changed, resumed=resumed is not None)
+            if self.on_result is not None:
+                await self.on_result(table, f"{table}-{key}", key_results, changed)
+                return f"{table}-{key}", None
+            return f"{table}-{key}", key_results
+
+    async def get_bea_data(self, table, session):
+        """
+        Aysnc calls for provided BEA table + linecode. All line codes are requested concurrently over the shared session.
+        """
+        table_keys = self.get_bea_keys(table)
+        start = time.perf_counter()
+        metrics.event("table_start", table=table, description=self.table_dict[table], line_codes=len(table_keys))
+        key_results = await asyncio.gather(*(self.get_linecode(session, table, k) for k in table_keys))
+        seconds = time.perf_counter() - start
+        metrics.observe("bea_table_fetch_seconds", seconds, table=table)
+        metrics.event("table_collected", table=table, seconds=round(seconds, 4))
+        return dict(key_results)
+
+    def start(self):
+        """
+        Fresh request slots and per run results, inside the event loop that will fetch
+        """
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.slots = asyncio.Semaphore(self.max_concurrency)
+        self.changed_keys = set()
+        self.failed = []
 
     async def async_bea_api(self):
         """
         Run all async functions
         """
+        self.start()
+        await asyncio.get_running_loop().run_in_executor(None, self.linecode_lookup)
         async with aiohttp.ClientSession() as session:
-            task_results = await asyncio.gather(*(self.get_bea_data("SAGDP4N", session), 
-                                                  self.get_bea_data("SAPCE2", session), 
-                                                  self.get_bea_data("SAINC30", session),
-                                                  self.get_bea_data("SAINC51", session),
-                                                  self.get_bea_data("SAGDP2N", session),
-                                                  self.get_bea_data("CAGDP9", session),
-                                                  self.get_bea_data("CAINC1", session),
-                                                  self.get_bea_data("CAINC30", session)),
-                                                  self.get_bea_data("CAINC4", session))
-            return task_results
+            task_results = await asyncio.gather(*(self.get_bea_data(table, session) for table in self.table_dict))
+        if self.failed:
+            raise bea_incomplete_error(sorted(self.failed))
+        return task_results
 
     def collect_data(self):
-        print("Collecting BEA data:")
-        for val in self.table_dict.values():
-            print(val)
-        print()
-        results = asyncio.run(self.async_bea_api()) 
-
-        print("BEA async complete")
-        print()
-        return results
+        with metrics.stage("fetch", tables=len(self.table_dict)):
+            return asyncio.run(self.async_bea_api())
 
+    def stream_data(self, on_result):
+        """
+        Hand each line code to the async on_result(table, code, data, changed) callback as it lands instead of
+        collecting every response, so memory is bounded by the requests in flight.
+        """
+        self.on_result = on_result
+        try:
+            with metrics.stage("fetch", tables=len(self.table_dict), streaming=True):
+                asyncio.run(self.async_bea_api())
+        finally:
+            self.on_result = None
@@ -0,0 +1,97 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+from datetime import datetime
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "bea_cache.db")
+
+
+class bea_cache():
+    """
+    On-disk cache of raw BEA GetData payloads keyed by (dataset, TableName, LineCode, GeoFips, year).
+    Every fetched payload is stored under the year it was requested with. The year="ALL" entry holds the
+    current full history, so incremental fetches are merged into it and its content hash tells whether a line code changed.
+    """
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.con = sqlite3.connect(path)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                dataset TEXT,
+                table_name TEXT,
+                line_code TEXT,
+                geo_fips TEXT,
+                year TEXT,
+                payload BLOB,
+                fetched_at REAL,
+                content_hash TEXT,
+                last_period INTEGER,
+                PRIMARY KEY (dataset, table_name, line_code, geo_fips, year))
+                         """)
+        self.con.commit()
+
+    def content_hash(self, data):
+        """
+        Hash of the data rows only, so request echoes and notes don't register as changes.
+        """
+        rows = sorted(data, key=self.row_key)
+        return hashlib.sha256(json.dumps(rows, sort_keys=True).encode()).hexdigest()
+
+    def row_key(self, row):
+        return (row.get("Code", ""), row.get("GeoFips", ""), row.get("TimePeriod", ""))
+
+    def get(self, dataset, table, line_code, geo_fips, year="ALL"):
+        row = self.con.execute("""
+            SELECT payload, fetched_at, content_hash, last_period
+            FROM responses
+            WHERE dataset = ? AND table_name = ? AND line_code = ? AND geo_fips = ? AND year = ?
+                               """, (dataset, table, line_code, geo_fips, year)).fetchone()
+        if row is None:
+            return None
+        return {"payload": zlib.decompress(row[0]), "fetched_at": row[1], "content_hash": row[2], "last_period": row[3]}
+
+    def put(self, dataset, table, line_code, geo_fips, year, payload):
+        """
+        Store a payload and return True when its data differs from what was cached under the same key.
+        """
+        data = json.loads(payload.decode("iso-8859-1"))["BEAAPI"]["Results"]["Data"]
+        data = data if isinstance(data, list) else [data]
+        content_hash = self.content_hash(data)
+        periods = [int(row["TimePeriod"][:4]) for row in data if row.get("TimePeriod", "")[:4].isdigit()]
+        previous = self.get(dataset, table, line_code, geo_fips, year)
+        self.con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (dataset, table, line_code, geo_fips, year, zlib.compress(payload), time.time(),
+                          content_hash, max(periods) if periods else None))
+        self.con.commit()
+        return previous is None or previous["content_hash"] != content_hash
+
+    def incremental_years(self, cached, revision_window):
+        """
+        Years to request for an incremental refresh: the last revision_window cached years and anything newer.
+        """
+        first_year = cached["last_period"] - revision_window + 1
+        return ",".join(str(year) for year in range(first_year, datetime.now().year + 1))
+
+    def merge(self, dataset, table, line_code, geo_fips, years, payload):
+        """
+        Replace the requested years in the cached full history with the new payload's rows.
+        Returns the merged payload and whether anything changed.
+        """
+        self.put(dataset, table, line_code, geo_fips, years, payload)
+        cached = json.loads(self.get(dataset, table, line_code, geo_fips)["payload"].decode("iso-8859-1"))
+        update = json.loads(payload.decode("iso-8859-1"))
+        new_data = update["BEAAPI"]["Results"]["Data"]
+        new_data = new_data if isinstance(new_data, list) else [new_data]
+        refreshed = set(years.split(","))
+        kept = [row for row in cached["BEAAPI"]["Results"]["Data"] if row["TimePeriod"][:4] not in refreshed]
+        cached["BEAAPI"]["Results"]["Data"] = sorted(kept + new_data, key=self.row_key)
+        merged = json.dumps(cached).encode("iso-8859-1")
+        changed = self.put(dataset, table, line_code, geo_fips, "ALL", merged)
+        return merged, changed
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,132 @@
+import os
+import json
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+
+from bea_metrics import metrics
+
+# refreshed catalog, kept out of version control beside the response cache
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "linecodes.csv")
+# catalog shipped with the repo, read until the first refresh
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inputs", "linecodes.csv")
+CATALOG_TTL_DAYS = 30
+
+
+class bea_catalog():
+    """
+    On-disk catalog of Regional line codes (Key, Desc, table), the one list bea_api and bea_data_prep both read.
+    It is refreshed from GetParameterValues when older than ttl_days, with the refresh time kept in linecodes.json.
+    Refreshes go to path (under cache/), and the bundled seed in inputs/ is read until there is one.
+    """
+    def __init__(self, path=CATALOG_PATH, ttl_days=CATALOG_TTL_DAYS, seed_path=SEED_PATH):
+        self.path = path
+        self.seed_path = seed_path
+        self.meta_path = os.path.splitext(path)[0] + ".json"
+        self.ttl = timedelta(days=ttl_days)
+        self.linecodes = None
+        self.index = None
+        self.aliases = {}
+
+    def source(self):
+        # the refreshed catalog, or the seed before the first refresh
+        return self.path if os.path.exists(self.path) else self.seed_path
+
+    def metadata(self):
+        meta_path = os.path.splitext(self.source())[0] + ".json"
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def stale(self):
+        refreshed_at = self.metadata().get("refreshed_at")
+        if refreshed_at is None or not os.path.exists(self.path):
+            return True
+        return datetime.now(timezone.utc) - datetime.fromisoformat(refreshed_at) > self.ttl
+
+    def parse(self, param_values):
+        """
+        GetParameterValues rows describe their table in a prefix: "[CAINC4] Wages and salaries"
+        """
+        parts = param_values.Desc.str.extract(r"^\[(?P<table>[^\]]+)\] (?P<Desc>.*)$")
+        return pd.DataFrame({"Key": param_values.Key, "Desc": parts.Desc, "table": parts.table}).dropna(subset=["table"])
+
+    def refresh(self, param_values, source="GetParameterValues"):
+        linecodes = self.parse(param_values)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        linecodes.to_csv(self.path + ".tmp", index=False)
+        os.replace(self.path + ".tmp", self.path)
+        meta = {"refreshed_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "source": source,
+                "rows": len(linecodes), "tables": int(linecodes.table.nunique())}
+        with open(self.meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        self.linecodes = linecodes.reset_index(drop=True)
+        self.index = None
+        self.aliases = {}
+        metrics.event("catalog_refreshed", path=self.path, **meta)
+
+    def load(self, fetch=None):
+        """
+        All line codes. fetch() returns a GetParameterValues frame and is only called when the catalog is missing or
+        stale. A failed refresh falls back to the stale catalog, or the seed.
+        """
+        if self.linecodes is None and fetch is not None and self.stale():
+            try:
+                self.refresh(fetch())
+            except Exception as e:
+                if not os.path.exists(self.source()):
+                    raise
+                metrics.event("catalog_refresh_failed", path=self.path, error=str(e))
+        if self.linecodes is None:
+            self.linecodes = pd.read_csv(self.source(), dtype="str", keep_default_na=False)
+        return self.linecodes
+
+    def table(self, table):
+        """
+        Line codes of one table, from an index built once per catalog
+        """
+        if self.index is None:
+            self.index = {name: rows.reset_index(drop=True) for name, rows in self.load().groupby("table", sort=False)}
+        return self.index.get(table, self.load().iloc[0:0])
+
+    def series_aliases(self, tables):
+        """
+        {alias: code} of line codes that publish the same series as a line code of an earlier table in tables, e.g.
+        CAINC4-20 and CAINC30-100 are both CAINC1-2 (Population). Series match on their description within tables of
+        one geography (CA* county or SA* state), and descriptions two line codes of one table share are never matched.
+        """
+        tables = tuple(tables)
+        if tables not in self.aliases:
+            linecodes = self.load()
+            rows = linecodes[linecodes.table.isin(tables)].drop_duplicates(["table", "Key"])
+            rows = rows.assign(code=rows.table + "-" + rows.Key,
+                               series=rows.Desc.str.strip().str.lower(),
+                               family=rows.table.str[:2],
+                               order=rows.table.map({table: order for order, table in enumerate(tables)}))
+            rows = rows[~rows.duplicated(["table", "series"], keep=False)].sort_values("order", kind="stable")
+            canonical = rows.groupby(["family", "series"]).code.transform("first")
+            self.aliases[tables] = dict(zip(rows.code[rows.code != canonical], canonical[rows.code != canonical]))
+        return self.aliases[tables]
+
+
+if __name__ == "__main__":
+    import argparse
+    from bea_async import bea_api
+
+    parser = argparse.ArgumentParser(description="Show or refresh the line code catalog")
+    parser.add_argument("--refresh", action="store_true", help="refresh from GetParameterValues now, regardless of the TTL")
+    parser.add_argument("--table", help="list the line codes of one table")
+    parser.add_argument("--aliases", action="store_true", help="list the line codes fetched once under another table's line code")
+    args = parser.parse_args()
+
+    catalog = bea_catalog()
+    if args.refresh:
+        catalog.refresh(bea_api(os.environ.get("BEA_KEY"), catalog=catalog).param_vals("Regional", "LineCode"))
+    if args.table:
+        print(catalog.table(args.table).to_string(index=False))
+    elif args.aliases:
+        print(json.dumps(bea_api(os.environ.get("BEA_KEY"), catalog=catalog).series_aliases(), indent=2))
+    else:
+        linecodes = catalog.load()
+        print(json.dumps({"path": catalog.source(), "stale": catalog.stale(), "rows": len(linecodes),
+                          "tables": int(linecodes.table.nunique()), **catalog.metadata()}, indent=2))
@@ -0,0 +1,101 @@
+import io
+import os
+import json
+import time
+import sqlite3
+import pyarrow.parquet as pq
+
+from bea_staging import bea_staging
+
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "bea_checkpoint.db")
+
+
+class bea_checkpoint():
+    """
+    Run checkpoint for extraction. Every (table, line code) result is persisted as soon as it lands, with whether it
+    changed, and failures are recorded instead of losing the run. A resumed run skips the line codes already done
+    and only requests the failed or missing ones. The checkpoint is cleared once the run's staging files are written.
+    """
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.con = sqlite3.connect(path)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS run (
+                started_at REAL,
+                config TEXT);
+            CREATE TABLE IF NOT EXISTS results (
+                table_name TEXT,
+                line_code TEXT,
+                status TEXT,
+                changed INTEGER,
+                data BLOB,
+                error TEXT,
+                attempts INTEGER,
+                updated_at REAL,
+                PRIMARY KEY (table_name, line_code));
+                               """)
+        self.con.commit()
+
+    def start(self, config, resume=False):
+        """
+        Begin a run. Resuming keeps the completed results of an unfinished run with the same config,
+        anything else starts from an empty checkpoint. Returns whether the run was resumed.
+        """
+        config = json.dumps(config, sort_keys=True)
+        run = self.con.execute("SELECT config FROM run").fetchone()
+        if resume and run is not None and run[0] == config:
+            return True
+        self.con.execute("DELETE FROM run")
+        self.con.execute("DELETE FROM results")
+        self.con.execute("INSERT INTO run VALUES (?, ?)", (time.time(), config))
+        self.con.commit()
+        return False
+
+    def counts(self):
+        rows = dict(self.con.execute("SELECT status, count(*) FROM results GROUP BY status").fetchall())
+        return rows.get("done", 0), rows.get("failed", 0)
+
+    def get(self, table, line_code):
+        """
+        (data, changed) for a line code completed in this run, None otherwise
+        """
+        row = self.con.execute("SELECT data, changed FROM results WHERE table_name = ? AND line_code = ? AND status = 'done'",
+                               (table, line_code)).fetchone()
+        if row is None:
+            return None
+        return pq.read_table(io.BytesIO(row[0])).to_pandas(), bool(row[1])
+
+    def put(self, table, line_code, df, changed):
+        buffer = io.BytesIO()
+        pq.write_table(bea_staging().to_arrow(df), buffer, compression="zstd")
+        self.con.execute("""
+            INSERT INTO results VALUES (?, ?, 'done', ?, ?, NULL, 1, ?)
+            ON CONFLICT (table_name, line_code) DO UPDATE SET
+                status = 'done', changed = excluded.changed, data = excluded.data, error = NULL,
+                attempts = attempts + 1, updated_at = excluded.updated_at
+                         """, (table, line_code, int(changed), buffer.getvalue(), time.time()))
+        self.con.commit()
+
+    def fail(self, table, line_code, error):
+        self.con.execute("""
+            INSERT INTO results VALUES (?, ?, 'failed', NULL, NULL, ?, 1, ?)
+            ON CONFLICT (table_name, line_code) DO UPDATE SET
+                status = 'failed', error = excluded.error, attempts = attempts + 1, updated_at = excluded.updated_at
+                         """, (table, line_code, str(error), time.time()))
+        self.con.commit()
+
+    def failures(self):
+        return self.con.execute("SELECT table_name, line_code, error FROM results WHERE status = 'failed' ORDER BY 1, 2").fetchall()
+
+    def finish(self):
+        """
+        The run's results are staged, start the next run from scratch
+        """
+        self.con.execute("DELETE FROM run")
+        self.con.execute("DELETE FROM results")
+        self.con.commit()
+        self.con.execute("VACUUM")
+
+    def close(self):
+        self.con.close()
@@ -1,97 +1,266 @@
-import pandas as pd
 from functools import lru_cache
 import json
-import re
 from concurrent.futures import ThreadPoolExecutor
 import os
+import time
+import asyncio
 
-from bea_async import bea_api
+from bea_async import bea_api, bea_incomplete_error
+from bea_cache import bea_cache, CACHE_PATH
+from bea_checkpoint import bea_checkpoint, CHECKPOINT_PATH
+from bea_staging import bea_staging, DATA_PATH
+from bea_geography import geo_fips, county_fips
+from bea_tables import TABLE_NAMES
+from bea_metrics import metrics
 
 
 class bea_data_clean():
     """
-    Region wide data from BEA includes state level, country level, and regional level full names. 
-    Reference Wikipedia to collect state + country names (50 states + DC + US).
+    Region wide data from BEA includes state level, country level, and regional level rows.
+    Keep the country + states + DC using the bundled geography reference in bea_geography, plus counties on county runs.
     """
-    @lru_cache
-    def get_state_names(self):
-        wiki_url = "https://en.wikipedia.org/wiki/List_of_states_and_territories_of_the_United_States"
-        wiki_states = pd.read_html(wiki_url)
-        dc = (wiki_states[2].iloc[0, 0],)
-        us = (re.search("United States", wiki_states[0][0][1]).group(0) + " *", ) # us code for country level data
-        states = tuple(state.replace("[B]", "") for state in wiki_states[1].droplevel(0, axis=1).iloc[:50, 0]) # remove annotations in name
-        return us + states + dc
-    
+    def __init__(self, cache_path=CACHE_PATH, incremental=False, revision_window=3, staging_format="parquet", geography="STATE",
+                 checkpoint_path=CHECKPOINT_PATH, resume=False):
+        """
+        cache_path = response cache location, None to always download without change detection
+        incremental = only request recent years (see bea_api), requires the cache
+        staging_format = parquet, feather or json (legacy), see bea_staging
+        geography = STATE or COUNTY, see bea_api
+        checkpoint_path = run checkpoint location, None to run without one, see bea_checkpoint
+        resume = continue the last unfinished run, only requesting line codes that failed or never ran
+        """
+        self.staging = bea_staging(DATA_PATH, staging_format)
+        self.cache_path = cache_path
+        self.incremental = incremental
+        self.revision_window = revision_window
+        self.geography = geography
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
+        self.checkpoint = None
+        self.changed_keys = set()
+        self.staged = {}
+        self.aliases = {}
+        self.filters = None
+
+    def start_checkpoint(self):
+        """
+        Open the run checkpoint. Resuming only applies to a run with the same settings.
+        """
+        if self.checkpoint_path is None:
+            return None
+        self.checkpoint = bea_checkpoint(self.checkpoint_path)
+        config = {"geography": self.geography, "incremental": self.incremental, "revision_window": self.revision_window}
+        resumed = self.checkpoint.start(config, self.resume)
+        done, failed = self.checkpoint.counts()
+        metrics.event("checkpoint", path=self.checkpoint_path, resumed=resumed, done=done, failed=failed)
+        return self.checkpoint
+
+    def finish_checkpoint(self):
+        # everything is staged, the next run starts from scratch
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    def api(self, key, cache):
+        return bea_api(key, cache=cache, incremental=self.incremental, revision_window=self.revision_window, geography=self.geography,
+                       checkpoint=self.start_checkpoint())
+
     @lru_cache
     def collect_bea_data(self, key):
         """
         Collect API data from bea_async library
         """
-        async_api = bea_api(key)
-        results =  async_api.collect_data()
+        cache = bea_cache(self.cache_path) if self.cache_path else None
+        async_api = self.api(key, cache)
+        try:
+            results = async_api.collect_data()
+        finally:
+            if cache is not None:
+                cache.close()
+        self.changed_keys = async_api.changed_keys
+        self.aliases = async_api.series_aliases()
         return results
     
-    def state_filter(self, data_dict, bea_variable):
+    def filter_states(self, df, bea_variable=None):
+        keep = df.GeoFips.isin(geo_fips())
+        if self.geography == "COUNTY":
+            keep |= county_fips(df.GeoFips)
+        if bea_variable is not None:
+            metrics.inc("bea_filter_rows_in_total", len(df), table=bea_variable)
+            metrics.inc("bea_filter_rows_out_total", int(keep.sum()), table=bea_variable)
+        return df[keep]
+
+    def staged_filters(self):
+        """
+        {staged file: filter settings it was written with}, from data/staged.json
+        """
+        if self.filters is None:
+            manifest = os.path.join(DATA_PATH, "staged.json")
+            self.filters = {}
+            if os.path.exists(manifest):
+                with open(manifest, "r") as f:
+                    self.filters = json.load(f)
+        return self.filters
+
+    def restage(self, bea_variable):
+        """
+        Whether a table's staged file has to be written whatever changed: it is missing, or was filtered for another geography
         """
-        Filter data for region names desired from Wikipedia and write data as JSON files
+        path = self.staging.file_path(bea_variable)
+        return not os.path.exists(path) or self.staged_filters().get(os.path.basename(path)) != {"geography": self.geography}
+
+    def state_filter(self, data_dict, bea_variable, changed=None):
+        """
+        Filter data for the country + state FIPS codes and write data as staging files, one line code at a time.
+        Tables without a changed line code keep their existing file, unless it is missing or was filtered for another geography.
+        changed = the table's changed line codes, by default those the response cache found changed
         """
-        df_joined = pd.concat(data_dict.values()).reset_index(drop=True)
-        df_joined_states = df_joined[df_joined.GeoName.isin(self.get_state_names())]
-        df_joined_states = df_joined_states.to_json()
-        file_path = os.path.join("data", f"{bea_variable}.json")
-        with open(file_path, "w") as outfile:
-            json.dump(df_joined_states, outfile)
-        outfile.close()
+        if changed is None:
+            changed = sorted(k for k in data_dict if k in self.changed_keys)
+        if not changed and self.restage(bea_variable):
+            changed = sorted(data_dict)
+        if not changed:
+            metrics.event("staging_unchanged", table=bea_variable)
+            return
+        start = time.perf_counter()
+        writer = self.staging.writer(bea_variable)
+        rows_in = 0
+        for df in data_dict.values():
+            rows_in += len(df)
+            writer.write(self.filter_states(df, bea_variable))
+        path = writer.close()
+        self.staged[bea_variable] = changed
+        seconds = time.perf_counter() - start
+        metrics.observe("bea_staging_seconds", seconds, table=bea_variable)
+        metrics.event("staged", table=bea_variable, rows_in=rows_in, rows_out=writer.rows, changed_line_codes=len(changed),
+                      bytes=os.path.getsize(path), seconds=round(seconds, 4))
 
     def write_files(self, bea_data_dict):
         """
-        The function to be run in each of the pools. Reference the linecode in the data to know which BEA data is being used.
-        """
-        if "SAGDP4N-1" in bea_data_dict.keys():
-            print("Writing BEA compensation data as JSON")
-            bea_data.state_filter(bea_data_dict, "compensation")
-        elif "SAPCE2-1" in bea_data_dict.keys():
-            print("Writing BEA consumption data as JSON")
-            bea_data.state_filter(bea_data_dict, "consumption_expenditures")
-        elif "SAINC30-10" in bea_data_dict.keys():
-            print("Writing BEA personal income data as JSON")
-            bea_data.state_filter(bea_data_dict, "personal_income")
-        elif "SAINC51-51" in bea_data_dict.keys():
-            print("Writing BEA disposable income data as JSON")
-            bea_data.state_filter(bea_data_dict, "disposable_income")
-        elif "CAINC4-1" in bea_data_dict.keys():
-            print("Writing BEA employment data as JSON")
-            bea_data.state_filter(bea_data_dict, "employment")
-        elif "CAINC30-10" in bea_data_dict.keys():
-            print("Writing BEA wages & salaries data as JSON")
-            bea_data.state_filter(bea_data_dict, "wages_salary")
-        elif "CAINC1-1" in bea_data_dict.keys():
-            print("Writing BEA population data as JSON")
-            bea_data.state_filter(bea_data_dict, "population")
-        elif "CAGDP9-1" in bea_data_dict.keys():
-            print("Writing BEA real GDP data as JSON")
-            bea_data.state_filter(bea_data_dict, "real_gdp")
-        elif "SAGDP2N-1" in bea_data_dict.keys():
-            print("Writing BEA GDP data as JSON")
-            bea_data.state_filter(bea_data_dict, "gdp")
+        The function to be run in each of the pools. A table's line codes are keyed by its BEA table code, e.g. CAINC30-240.
+        No single line code identifies a table, since aliases of another table's line codes are left out.
+        """
+        if bea_data_dict:
+            self.state_filter(bea_data_dict, TABLE_NAMES[next(iter(bea_data_dict)).split("-")[0]])
+
+    def write_manifests(self, consumed=()):
+        """
+        data/changed.json lists the staged files rewritten since the last load with their changed line codes, adding this
+        run's to those of earlier runs until bea_db_load consumes them. data/aliases.json the line codes stored under
+        another table's line code (see bea_api.series_aliases) for bea_db_load. data/staged.json the geography each
+        staged file was filtered for, so a run for another geography rewrites it.
+        consumed = tables already loaded from the files staged this run
+        """
+        changed = {}
+        if os.path.exists(os.path.join(DATA_PATH, "changed.json")):
+            with open(os.path.join(DATA_PATH, "changed.json"), "r") as f:
+                changed = json.load(f)
+        for bea_variable, codes in self.staged.items():
+            changed[bea_variable] = sorted(set(changed.get(bea_variable, ())) | set(codes))
+        for bea_variable in consumed:
+            changed.pop(bea_variable, None)
+        filters = self.staged_filters()
+        for bea_variable in self.staged:
+            filters[os.path.basename(self.staging.file_path(bea_variable))] = {"geography": self.geography}
+        for name, manifest in (("changed.json", changed), ("aliases.json", self.aliases), ("staged.json", filters)):
+            with open(os.path.join(DATA_PATH, name), "w") as outfile:
+                json.dump(manifest, outfile, indent=2)
 
     def file_save_threads(self, bea_data):
         """
-        Execute multiple pools for the thread to run write_file functions 
+        Execute multiple pools for the thread to run write_file functions.
+        Afterwards record which staged files were rewritten and their changed line codes, see write_manifests.
         """
+        self.staged = {}
         with ThreadPoolExecutor() as executor:
-            executor.map(self.write_files, bea_data)
+            list(executor.map(self.write_files, bea_data))
+        self.write_manifests()
+        self.finish_checkpoint()
+
+    def stream_files(self, key):
+        """
+        Out of core extract: each line code is filtered and appended to its table's staging file as it lands,
+        so memory is bounded by the requests in flight instead of the whole (county) dataset.
+        Writes run on one thread, files of tables without a changed line code are left as they were unless restage says otherwise.
+        If any line code fails no staging file is replaced, and a resumed run rewrites them from the checkpoint.
+        """
+        cache = bea_cache(self.cache_path) if self.cache_path else None
+        async_api = self.api(key, cache)
+        writers = {}
+        codes = {}
+        self.staged = {}
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def write_chunk(table, code, df, changed):
+            bea_variable = async_api.table_names[table]
+            if bea_variable not in writers:
+                writers[bea_variable] = self.staging.writer(bea_variable)
+            writers[bea_variable].write(self.filter_states(df, bea_variable))
+            codes.setdefault(bea_variable, []).append(code)
+            if changed:
+                self.staged.setdefault(bea_variable, []).append(code)
+
+        async def on_result(table, code, df, changed):
+            await asyncio.get_running_loop().run_in_executor(executor, write_chunk, table, code, df, changed)
+
+        try:
+            async_api.stream_data(on_result)
+        except Exception:
+            executor.shutdown()
+            for writer in writers.values():
+                writer.close(commit=False)
+            raise
+        finally:
+            executor.shutdown()
+            if cache is not None:
+                cache.close()
+        self.aliases = async_api.series_aliases()
+        for bea_variable, writer in writers.items():
+            if bea_variable not in self.staged and self.restage(bea_variable):
+                self.staged[bea_variable] = codes[bea_variable]
+            if bea_variable in self.staged:
+                self.staged[bea_variable].sort()
+                path = writer.close()
+                metrics.event("staged", table=bea_variable, rows_out=writer.rows, changed_line_codes=len(self.staged[bea_variable]),
+                              bytes=os.path.getsize(path))
+            else:
+                writer.close(commit=False)
+                metrics.event("staging_unchanged", table=bea_variable)
+        self.write_manifests()
+        self.finish_checkpoint()
 
 if __name__ == "__main__":
-    from datetime import datetime
-    
-    startTime = datetime.now()
+    import argparse
 
-    key = os.environ.get("BEA_KEY")
-    bea_data = bea_data_clean()
-    data = bea_data.collect_bea_data(key)
-    bea_data.file_save_threads(data)
+    parser = argparse.ArgumentParser(description="Extract BEA data as staging files")
+    parser.add_argument("--incremental", action="store_true", help="only request years after the last cached period")
+    parser.add_argument("--revision-window", type=int, default=3, help="trailing cached years to re-request on incremental runs")
+    parser.add_argument("--no-cache", action="store_true", help="download everything without the response cache")
+    parser.add_argument("--staging-format", choices=("parquet", "feather", "json"), default="parquet")
+    parser.add_argument("--geography", choices=("STATE", "COUNTY"), default="STATE", help="COUNTY adds county rows for the CA* tables")
+    parser.add_argument("--chunked", action="store_true", help="write each line code to staging as it lands instead of holding every table in memory")
+    parser.add_argument("--resume", action="store_true", help="continue the last unfinished run, retrying only failed or missing line codes")
+    parser.add_argument("--no-checkpoint", action="store_true", help="don't persist line codes as they land")
+    parser.add_argument("--log-file", help="append JSON logs to this file instead of stdout")
+    parser.add_argument("--metrics-file", help="write run metrics in the Prometheus text format to this file")
+    args = parser.parse_args()
+    metrics.configure(args.log_file)
 
-    print("BEA data saved as JSON in data folder")
-    print()
-    print("Run time", datetime.now() - startTime)
+    key = os.environ.get("BEA_KEY")
+    bea_data = bea_data_clean(None if args.no_cache else CACHE_PATH, args.incremental, args.revision_window, args.staging_format, args.geography,
+                              None if args.no_checkpoint else CHECKPOINT_PATH, args.resume)
+    try:
+        with metrics.stage("extract", staging_format=args.staging_format):
+            if args.chunked:
+                bea_data.stream_files(key)
+            else:
+                data = bea_data.collect_bea_data(key)
+                with metrics.stage("stage"):
+                    bea_data.file_save_threads(data)
+    except bea_incomplete_error as e:
+        metrics.event("run_incomplete", failed=[code for code, _ in e.failed], hint="rerun with --resume to retry only these")
+        raise SystemExit(1)
+    finally:
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
@@ -0,0 +1,35 @@
+import os
+import pandas as pd
+from functools import lru_cache
+
+# bump when inputs/geography.csv changes
+GEOGRAPHY_VERSION = "2024.1"
+GEOGRAPHY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inputs", "geography.csv")
+
+
+@lru_cache(maxsize=None)
+def geography():
+    """
+    Bundled geography reference: FIPS code, name, postal abbreviation, level (nation, region, state) and BEA region.
+    Loaded once per process.
+    """
+    return pd.read_csv(GEOGRAPHY_PATH, dtype="str", keep_default_na=False)
+
+
+@lru_cache(maxsize=None)
+def geo_fips(levels=("nation", "state")):
+    """
+    FIPS codes for the given levels. The default (US + 50 states + DC) is what state_filter keeps.
+    """
+    geo = geography()
+    return frozenset(geo.geofips[geo.level.isin(levels)])
+
+
+def county_fips(fips):
+    """
+    Boolean mask over a Series of FIPS codes for counties (and county equivalents) inside a state: a state prefix
+    and a non zero county code. Counties aren't in the bundled reference, there are too many and they change often.
+    """
+    geo = geography()
+    prefixes = frozenset(geo.geofips[geo.level == "state"].str[:2])
+    return fips.str[:2].isin(prefixes) & (fips.str[2:] != "000")
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class bea_metrics():
+    """
+    Structured run metrics shared by the extract, transform and load modules.
+    event() writes one JSON log line. inc(), observe() and gauge() aggregate per metric name + labels,
+    and write_prometheus() dumps the aggregates in the Prometheus text format (e.g. for the node_exporter textfile collector).
+    """
+    def __init__(self):
+        self.log = sys.stdout
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+        self.gauges = {}
+
+    def configure(self, log_path=None):
+        """
+        log_path = append JSON log lines to this file instead of stdout
+        """
+        if log_path is not None:
+            self.log = open(log_path, "a")
+
+    def event(self, event, **fields):
+        line = json.dumps({"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "event": event, **fields}, default=str)
+        with self.lock:
+            self.log.write(line + "\n")
+            self.log.flush()
+
+    def key(self, name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Count, sum and max of a value such as a latency
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            count, total, peak = self.summaries.get(key, (0, 0.0, value))
+            self.summaries[key] = (count + 1, total + value, max(peak, value))
+
+    def gauge(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    @contextmanager
+    def stage(self, stage, **labels):
+        """
+        Time a block, logging a stage event with its wall time and the process peak RSS
+        """
+        start = time.perf_counter()
+        self.event("stage_start", stage=stage, **labels)
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe("bea_stage_seconds", seconds, stage=stage, **labels)
+            self.gauge("bea_peak_rss_mb", peak_rss_mb())
+            self.event("stage_end", stage=stage, seconds=round(seconds, 4), peak_rss_mb=round(peak_rss_mb(), 1), **labels)
+
+    def prometheus(self):
+        def series(name, labels, value):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+        lines = []
+        with self.lock:
+            for metric_type, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    lines += [series(name, labels, value) for (key, labels), value in sorted(values.items()) if key == name]
+            for name in sorted({name for name, _ in self.summaries}):
+                lines.append(f"# TYPE {name} summary")
+                for (key, labels), (count, total, peak) in sorted(self.summaries.items()):
+                    if key == name:
+                        lines += [series(f"{name}_count", labels, count), series(f"{name}_sum", labels, total)]
+                lines.append(f"# TYPE {name}_max gauge")
+                lines += [series(f"{name}_max", labels, peak) for (key, labels), (count, total, peak) in sorted(self.summaries.items()) if key == name]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # written to a temporary file and renamed, so a scraper never reads half a file
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+
+# one registry per process
+metrics = bea_metrics()
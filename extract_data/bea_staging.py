@@ -0,0 +1,149 @@
+import os
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pyarrow.ipc as ipc
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+STAGING_FORMATS = {"parquet": ".parquet", "feather": ".arrow", "json": ".json"}
+# run manifests bea_data_clean.write_manifests keeps beside the staged tables
+MANIFEST_FILES = ("changed.json", "aliases.json", "staged.json")
+STAGING_SCHEMA = pa.schema([("Code", pa.string()),
+                            ("GeoFips", pa.string()),
+                            ("GeoName", pa.string()),
+                            ("TimePeriod", pa.string()),
+                            ("CL_UNIT", pa.string()),
+                            ("UNIT_MULT", pa.int64()),
+                            ("DataValue", pa.float64()),
+                            ("NoteRef", pa.string())])
+
+
+class bea_staging():
+    """
+    Staging files between extract and transform, one file per table.
+    parquet = typed, zstd compressed columns (default)
+    feather = uncompressed Arrow IPC, memory mapped into pa.Tables without copying
+    json = legacy double-encoded DataFrame.to_json files
+    """
+    def __init__(self, data_path=DATA_PATH, staging_format="parquet"):
+        if staging_format not in STAGING_FORMATS:
+            raise ValueError(f"Unknown staging format {staging_format}, expected one of {tuple(STAGING_FORMATS)}")
+        self.data_path = data_path
+        self.staging_format = staging_format
+        self.extension = STAGING_FORMATS[staging_format]
+
+    def file_path(self, table):
+        return os.path.join(self.data_path, f"{table}{self.extension}")
+
+    def to_arrow(self, df):
+        """
+        Cast to the staging schema. NoteRef is optional in BEA responses.
+        """
+        df = df.copy()
+        if "NoteRef" not in df.columns:
+            df["NoteRef"] = None
+        df = df[STAGING_SCHEMA.names]
+        return pa.Table.from_pandas(df, schema=STAGING_SCHEMA, preserve_index=False)
+
+    def write(self, table, df):
+        path = self.file_path(table)
+        if self.staging_format == "parquet":
+            pq.write_table(self.to_arrow(df), path, compression="zstd")
+        elif self.staging_format == "feather":
+            feather.write_feather(self.to_arrow(df), path, compression="uncompressed")
+        else:
+            with open(path, "w") as outfile:
+                json.dump(df.to_json(), outfile)
+        return path
+
+    def writer(self, table):
+        """
+        Append a table one chunk at a time, see staging_writer
+        """
+        return staging_writer(self, table)
+
+    def read(self, table):
+        """
+        Read a staged table as a pa.Table. Parquet and Arrow IPC files are memory mapped.
+        """
+        path = self.file_path(table)
+        if self.staging_format == "parquet":
+            return pq.read_table(path, memory_map=True)
+        elif self.staging_format == "feather":
+            return feather.read_table(path, memory_map=True)
+        with open(path, "r") as json_file:
+            json_dict = json.loads(json.load(json_file))
+        return pa.Table.from_pandas(pd.DataFrame.from_dict(json_dict), preserve_index=False)
+
+    def batches(self, table, batch_size=100000):
+        """
+        Read a staged table as record batches of at most batch_size rows, without loading the whole file.
+        Legacy JSON files can't be read incrementally.
+        """
+        path = self.file_path(table)
+        if self.staging_format == "parquet":
+            yield from pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size)
+        elif self.staging_format == "feather":
+            with pa.memory_map(path) as source:
+                reader = ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield from pa.Table.from_batches([reader.get_batch(i)]).to_batches(max_chunksize=batch_size)
+        else:
+            yield from self.read(table).to_batches(max_chunksize=batch_size)
+
+    def tables(self):
+        """
+        Tables staged in this format, without the run manifests
+        """
+        return sorted(file[:-len(self.extension)] for file in os.listdir(self.data_path)
+                      if file.endswith(self.extension) and file not in MANIFEST_FILES)
+
+
+class staging_writer():
+    """
+    Writes one staged table a chunk (e.g. a line code) at a time, so the table never has to be concatenated in memory.
+    Parquet chunks become row groups and feather chunks record batches. Legacy JSON still collects the chunks.
+    Chunks go to a temporary file that replaces the staged file on close(commit=True), and is discarded otherwise.
+    """
+    def __init__(self, staging, table):
+        self.staging = staging
+        self.table = table
+        self.path = staging.file_path(table)
+        self.temp_path = self.path + ".tmp"
+        self.writer = None
+        self.frames = []
+        self.rows = 0
+
+    def write(self, df):
+        self.rows += len(df)
+        if self.staging.staging_format == "json":
+            self.frames.append(df)
+            return
+        data = self.staging.to_arrow(df)
+        if self.writer is None:
+            if self.staging.staging_format == "parquet":
+                self.writer = pq.ParquetWriter(self.temp_path, STAGING_SCHEMA, compression="zstd")
+            else:
+                self.writer = ipc.new_file(self.temp_path, STAGING_SCHEMA)
+        self.writer.write_table(data)
+
+    def close(self, commit=True):
+        if self.staging.staging_format == "json":
+            if commit:
+                df = pd.concat(self.frames).reset_index(drop=True) if self.frames else pd.DataFrame(columns=STAGING_SCHEMA.names)
+                self.staging.write(self.table, df)
+            self.frames = []
+            return self.path
+        if self.writer is None:
+            if not commit:
+                return self.path
+            # no chunks, write an empty table so the staged file still exists
+            self.write(pd.DataFrame(columns=STAGING_SCHEMA.names))
+        self.writer.close()
+        if commit:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+        return self.path
@@ -0,0 +1,136 @@
+import os
+import json
+import asyncio
+import random
+import argparse
+import pandas as pd
+from aiohttp import web
+
+from bea_geography import geography
+from bea_catalog import SEED_PATH
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# BEA marks the country level row with an asterisk
+STATES = {row.geofips: row.geoname + " *" if row.level == "nation" else row.geoname for row in geography().itertuples()}
+
+
+class bea_stub_server():
+    """
+    Local stand-in for the BEA API. Serves canned GetData responses from fixtures/{TableName}-{LineCode}.json
+    when present, otherwise a synthetic Regional response, plus GetParameterValues for LineCode from the line code catalog.
+    fail_rate injects 429/503 GetData responses to exercise client retries.
+    GeoFips=STATE serves the US, BEA regions and states, GeoFips=COUNTY serves synthetic counties (CA* tables only).
+    line_codes = serve at most this many line codes per table
+    """
+    def __init__(self, fixture_path=FIXTURE_PATH, years=range(1998, 2023), fail_rate=0.0, latency=0.0,
+                 counties=3100, line_codes=None):
+        self.fixture_path = fixture_path
+        self.years = tuple(years)
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.counties = self.synthetic_counties(counties)
+        self.line_codes = line_codes
+        self.requests = 0
+
+    def synthetic_counties(self, count):
+        geo = geography()
+        states = geo[geo.level == "state"]
+        counties = {}
+        county = 1
+        while len(counties) < count:
+            # counties are numbered with odd codes inside each state, like the real FIPS scheme
+            for row in states.itertuples():
+                if len(counties) >= count:
+                    break
+                counties[f"{row.geofips[:2]}{2 * county - 1:03d}"] = f"County {county}, {row.abbreviation}"
+            county += 1
+        return counties
+
+    def linecodes(self):
+        endpoints = pd.read_csv(SEED_PATH, dtype="str", keep_default_na=False)
+        if self.line_codes is not None:
+            endpoints = endpoints.groupby("table", sort=False).head(self.line_codes)
+        return [{"Key": row.Key, "Desc": f"[{row.table}] {row.Desc}"} for row in endpoints.itertuples()]
+
+    def synthetic_data(self, table, line_code, year_param="ALL", geo_fips="STATE"):
+        rng = random.Random(f"{table}-{line_code}-{geo_fips}")
+        requested = None if year_param.upper() == "ALL" else set(year_param.split(","))
+        data = []
+        for fips, name in (self.counties if geo_fips.upper() == "COUNTY" else STATES).items():
+            base = rng.uniform(1e3, 1e6)
+            for i, year in enumerate(self.years):
+                if requested is not None and str(year) not in requested:
+                    continue
+                data.append({"Code": f"{table}-{line_code}",
+                             "GeoFips": fips,
+                             "GeoName": name,
+                             "TimePeriod": str(year),
+                             "CL_UNIT": "Thousands of dollars",
+                             "UNIT_MULT": "3",
+                             "DataValue": f"{base * 1.03 ** i:,.0f}"})
+        return data
+
+    def get_data(self, params):
+        table, line_code, geo_fips = params.get("TableName"), params.get("LineCode"), params.get("GeoFips", "STATE")
+        if geo_fips.upper() == "COUNTY" and not table.startswith("CA"):
+            return {"BEAAPI": {"Results": {"Error": {"APIErrorCode": "40", "APIErrorDescription": f"GeoFips COUNTY is not available for {table}"}}}}
+        fixture = os.path.join(self.fixture_path, f"{table}-{line_code}.json")
+        if geo_fips.upper() == "STATE" and os.path.exists(fixture):
+            with open(fixture, "r") as f:
+                return json.load(f)
+        dimensions = [{"Name": name, "DataType": "numeric" if name in ("UNIT_MULT", "DataValue") else "string", "IsValue": "0"}
+                      for name in ("Code", "GeoFips", "GeoName", "TimePeriod", "CL_UNIT", "UNIT_MULT", "DataValue")]
+        return {"BEAAPI": {"Request": {"RequestParam": [{"ParameterName": k, "ParameterValue": v} for k, v in params.items()]},
+                           "Results": {"Statistic": table, "Dimensions": dimensions,
+                                       "Data": self.synthetic_data(table, line_code, params.get("Year", "ALL"), geo_fips),
+                                       "Notes": [{"NoteRef": " ", "NoteText": "Last updated: January 1, 2024."}]}}}
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = {k: v for k, v in request.query.items()}
+        method = {k.lower(): v for k, v in params.items()}.get("method", "").lower()
+        # only GetData goes through bea_api's retries
+        if method == "getdata" and random.random() < self.fail_rate:
+            return web.Response(status=random.choice((429, 503)))
+        if method == "getparametervalues":
+            body = {"BEAAPI": {"Request": {"RequestParam": []}, "Results": {"ParamValue": self.linecodes()}}}
+        elif method == "getdata":
+            body = self.get_data(params)
+        else:
+            body = {"BEAAPI": {"Error": {"APIErrorCode": "3", "APIErrorDescription": f"Unknown method {method}"}}}
+        return web.json_response(body)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api/data/", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8080):
+        """
+        Start in the running loop, returning the runner and base url to hand to bea_api(base_url=...).
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        return runner, f"http://{host}:{port}/api/data/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve canned BEA API responses locally")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", default=FIXTURE_PATH)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--counties", type=int, default=3100, help="synthetic counties served for GeoFips=COUNTY")
+    parser.add_argument("--line-codes", type=int, help="line codes served per table")
+    parser.add_argument("--start-year", type=int, default=1998)
+    parser.add_argument("--end-year", type=int, default=2022)
+    args = parser.parse_args()
+
+    stub = bea_stub_server(args.fixtures, range(args.start_year, args.end_year + 1), args.fail_rate, args.latency,
+                           counties=args.counties, line_codes=args.line_codes)
+    web.run_app(stub.app(), host="127.0.0.1", port=args.port)
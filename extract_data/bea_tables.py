@@ -0,0 +1,28 @@
+# Registry of the BEA Regional tables the pipeline loads, the one place a table is declared.
+# code = BEA table name, name = staging file + DuckDB table, description = what it holds.
+# Order matters: a series several tables publish is fetched for the first of them, see bea_catalog.series_aliases
+TABLES = ({"code": "SAINC30", "name": "personal_income", "description": "Personal income"},
+          {"code": "SAGDP4N", "name": "compensation", "description": "Employee compensation"},
+          {"code": "SAPCE2", "name": "consumption_expenditures", "description": "Personal consumption expenditures"},
+          {"code": "SAINC51", "name": "disposable_income", "description": "Disposable income"},
+          {"code": "SAGDP2N", "name": "gdp", "description": "GDP"},
+          {"code": "CAGDP9", "name": "real_gdp", "description": "Real GDP"},
+          {"code": "CAINC1", "name": "population", "description": "Population"},
+          {"code": "CAINC30", "name": "wages_salary", "description": "Wages"},
+          {"code": "CAINC4", "name": "employment", "description": "Employment"})
+
+TABLE_DESCRIPTIONS = {table["code"]: table["description"] for table in TABLES}
+TABLE_NAMES = {table["code"]: table["name"] for table in TABLES}
+TABLE_CODES = {table["name"]: table["code"] for table in TABLES}
+
+
+def select_tables(tables=None):
+    """
+    BEA codes of tables given by code or name, in registry order. None for every table.
+    """
+    if tables is None:
+        return tuple(TABLE_NAMES)
+    unknown = [table for table in tables if table not in TABLE_NAMES and table not in TABLE_CODES]
+    if unknown:
+        raise ValueError(f"Unknown tables {unknown}, expected codes or names from bea_tables.TABLES")
+    return tuple(code for code, name in TABLE_NAMES.items() if code in tables or name in tables)
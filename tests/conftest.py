@@ -0,0 +1,69 @@
+import os
+import sys
+import socket
+import asyncio
+import aiohttp
+import threading
+import pytest
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+EXTRACT_PATH = os.path.join(TESTS_PATH, "..", "extract_data")
+TRANSFORM_PATH = os.path.join(TESTS_PATH, "..", "transform_load_data")
+sys.path[:0] = [EXTRACT_PATH, TRANSFORM_PATH]
+
+from bea_metrics import metrics
+from bea_async import bea_api, rate_limiter
+from bea_catalog import bea_catalog
+from bea_data_json import bea_data_clean
+
+# the stub accepts any key of the length beaapi checks for
+STUB_KEY = "00000000-0000-0000-0000-000000000000"
+metrics.configure(os.devnull)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def stub_batch(url, load, table="SAINC30", table_name="personal_income"):
+    """
+    The first catalog line code of a table from the stub, filtered and transformed the way bea_stream loads it
+    """
+    line_code = bea_catalog().table(table).Key.iloc[0]
+    async def run():
+        api = bea_api(STUB_KEY, base_url=url, limiter=rate_limiter(10 ** 6, 10 ** 12, 10 ** 6))
+        api.start()
+        async with aiohttp.ClientSession() as session:
+            df, _ = await api.get_state_linecodes(session, table, line_code)
+        return df
+    df = bea_data_clean(cache_path=None, checkpoint_path=None).filter_states(asyncio.run(run()))
+    prep = load.bea_prep
+    batch = prep.clean_table(table_name, prep.bea_table(prep.staging.to_arrow(df)))
+    assert batch.num_rows > 0
+    return batch
+
+
+@pytest.fixture
+def serve():
+    """
+    serve(stub) runs a bea_stub_server on its own event loop thread and returns its base url,
+    so code under test can call asyncio.run itself
+    """
+    servers = []
+
+    def start(stub):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        runner, url = asyncio.run_coroutine_threadsafe(stub.start(port=free_port()), loop).result()
+        servers.append((loop, thread, runner))
+        return url
+
+    yield start
+    for loop, thread, runner in servers:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,70 @@
+import asyncio
+import aiohttp
+
+from bea_stub_server import bea_stub_server
+from bea_async import bea_api, rate_limiter
+from bea_cache import bea_cache
+
+STUB_KEY = "00000000-0000-0000-0000-000000000000"
+
+
+class recording_stub(bea_stub_server):
+    """
+    Stub keeping the Year parameter of each GetData request
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.years_requested = []
+
+    async def handle(self, request):
+        if request.query.get("method") == "GetData":
+            self.years_requested.append(request.query.get("Year"))
+        return await super().handle(request)
+
+
+def fetch(api, table="SAINC30", line_code="20"):
+    """
+    One line code through bea_api's cache, returning the changed_keys of the run
+    """
+    async def run():
+        api.start()
+        async with aiohttp.ClientSession() as session:
+            await api.get_linecode(session, table, line_code)
+        return api.changed_keys
+    return asyncio.run(run())
+
+
+def cached_api(url, path, **kwargs):
+    return bea_api(STUB_KEY, base_url=url, cache=bea_cache(path), limiter=rate_limiter(10 ** 6, 10 ** 12, 10 ** 6), **kwargs)
+
+
+def test_cache_miss_then_hit(serve, tmp_path):
+    stub = recording_stub(fixture_path=str(tmp_path), years=range(2015, 2023))
+    api = cached_api(serve(stub), tmp_path / "cache.db")
+    assert fetch(api) == {"SAINC30-20"}
+    assert api.cache.get("Regional", "SAINC30", "20", "STATE")["last_period"] == 2022
+    # the same data again is a hit: requested, but not changed
+    assert fetch(api) == set()
+    assert stub.years_requested == ["ALL", "ALL"]
+    api.cache.close()
+
+
+def test_revised_data_is_changed(serve, tmp_path):
+    stub = recording_stub(fixture_path=str(tmp_path), years=range(2015, 2023))
+    api = cached_api(serve(stub), tmp_path / "cache.db")
+    fetch(api)
+    stub.years = tuple(range(2015, 2024))
+    assert fetch(api) == {"SAINC30-20"}
+    api.cache.close()
+
+
+def test_incremental_requests_revision_window(serve, tmp_path):
+    stub = recording_stub(fixture_path=str(tmp_path), years=range(2015, 2023))
+    url = serve(stub)
+    fetch(cached_api(url, tmp_path / "cache.db"))
+    api = cached_api(url, tmp_path / "cache.db", incremental=True, revision_window=2)
+    assert fetch(api) == set()
+    assert stub.years_requested[-1].split(",")[0] == "2021"
+    # the merged history still holds every year
+    assert api.cache.get("Regional", "SAINC30", "20", "STATE")["last_period"] == 2022
+    api.cache.close()
@@ -0,0 +1,74 @@
+import pytest
+from aiohttp import web
+
+from bea_stub_server import bea_stub_server
+from bea_async import bea_api, bea_incomplete_error, rate_limiter
+from bea_catalog import bea_catalog
+from bea_checkpoint import bea_checkpoint
+
+STUB_KEY = "00000000-0000-0000-0000-000000000000"
+CONFIG = {"geography": "STATE", "incremental": False, "revision_window": 3}
+
+
+class failing_stub(bea_stub_server):
+    """
+    Stub answering GetData for the line codes in failing with 503, and keeping the line codes it was asked for
+    """
+    def __init__(self, failing=(), **kwargs):
+        super().__init__(**kwargs)
+        self.failing = set(failing)
+        self.line_codes_requested = []
+
+    async def handle(self, request):
+        if request.query.get("method") == "GetData":
+            line_code = request.query.get("LineCode")
+            self.line_codes_requested.append(line_code)
+            if line_code in self.failing:
+                self.requests += 1
+                return web.Response(status=503)
+        return await super().handle(request)
+
+
+def checkpointed_api(url, tmp_path, resume):
+    checkpoint = bea_checkpoint(str(tmp_path / "checkpoint.db"))
+    checkpoint.start(CONFIG, resume)
+    api = bea_api(STUB_KEY, base_url=url, max_retries=0, limiter=rate_limiter(10 ** 6, 10 ** 12, 10 ** 6),
+                  checkpoint=checkpoint, catalog=bea_catalog(str(tmp_path / "linecodes.csv")))
+    # one table keeps the run small
+    api.table_dict = {"SAINC30": api.table_dict["SAINC30"]}
+    return api, checkpoint
+
+
+def test_resume_retries_failed_line_codes(serve, tmp_path):
+    stub = failing_stub(fixture_path=str(tmp_path), years=range(2019, 2023), line_codes=3)
+    url = serve(stub)
+    api, checkpoint = checkpointed_api(url, tmp_path, resume=False)
+    line_codes = list(api.get_bea_keys("SAINC30"))
+    assert len(line_codes) == 3
+    stub.failing = {line_codes[0]}
+    with pytest.raises(bea_incomplete_error) as e:
+        api.collect_data()
+    assert [code for code, _ in e.value.failed] == [f"SAINC30-{line_codes[0]}"]
+    assert checkpoint.counts() == (2, 1)
+    checkpoint.close()
+
+    stub.failing = set()
+    stub.line_codes_requested = []
+    api, checkpoint = checkpointed_api(url, tmp_path, resume=True)
+    (results,) = api.collect_data()
+    assert stub.line_codes_requested == [line_codes[0]]
+    assert sorted(results) == sorted(f"SAINC30-{code}" for code in line_codes)
+    assert all(df is not None and len(df) > 0 for df in results.values())
+    checkpoint.close()
+
+
+def test_resume_with_other_settings_starts_over(serve, tmp_path):
+    stub = failing_stub(fixture_path=str(tmp_path), years=range(2019, 2023), line_codes=3)
+    url = serve(stub)
+    api, checkpoint = checkpointed_api(url, tmp_path, resume=False)
+    api.collect_data()
+    checkpoint.close()
+    checkpoint = bea_checkpoint(str(tmp_path / "checkpoint.db"))
+    assert not checkpoint.start({**CONFIG, "geography": "COUNTY"}, resume=True)
+    assert checkpoint.counts() == (0, 0)
+    checkpoint.close()
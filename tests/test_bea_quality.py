@@ -0,0 +1,61 @@
+import os
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+from conftest import TRANSFORM_PATH, stub_batch
+from bea_stub_server import bea_stub_server
+from bea_db_load import db_load
+from bea_quality import bea_quality_error
+
+
+def loader(tmp_path, arrow_dict=None, swap=False):
+    load = db_load(db_path=str(tmp_path / "bea.db"), export_format="none", quality_report=None, arrow_dict=arrow_dict, swap=swap)
+    load.bea_prep.data_path = str(tmp_path)
+    return load
+
+
+def row_count(tmp_path):
+    con = duckdb.connect(str(tmp_path / "bea.db"), read_only=True)
+    rows = con.execute("select count(*), count(distinct geofips) from personal_income").fetchone()
+    con.close()
+    return rows
+
+
+@pytest.fixture
+def loaded(serve, tmp_path, monkeypatch):
+    """
+    A database with one good personal_income load, and that load's batch
+    """
+    monkeypatch.chdir(TRANSFORM_PATH)
+    url = serve(bea_stub_server(fixture_path=str(tmp_path), years=range(2019, 2023)))
+    batch = stub_batch(url, loader(tmp_path))
+    loader(tmp_path, {"personal_income": batch}).duckdb()
+    return batch
+
+
+def few_states(batch):
+    # too few states for the geography rule, and the merge prunes the rest
+    keep = pa.array(sorted(set(batch["geofips"].to_pylist()))[:10])
+    return batch.filter(pc.is_in(batch["geofips"], value_set=keep))
+
+
+@pytest.mark.parametrize("swap", [False, True])
+def test_quality_failure_rolls_back(loaded, tmp_path, swap):
+    before = row_count(tmp_path)
+    with pytest.raises(bea_quality_error, match="geography"):
+        loader(tmp_path, {"personal_income": few_states(loaded)}, swap).duckdb()
+    assert row_count(tmp_path) == before
+    assert not os.path.exists(tmp_path / "bea.db.swap")
+
+
+def test_merge_failure_rolls_back(loaded, tmp_path):
+    before = row_count(tmp_path)
+    broken = few_states(loaded)
+    # a NULL key breaks the merge before any check runs
+    broken = broken.set_column(broken.column_names.index("code"), "code", pa.nulls(broken.num_rows, pa.string()))
+    with pytest.raises(duckdb.Error):
+        loader(tmp_path, {"personal_income": broken}, swap=True).duckdb()
+    assert row_count(tmp_path) == before
+    assert not os.path.exists(tmp_path / "bea.db.swap")
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import aiohttp
+import pytest
+from aiohttp import web
+
+EXTRACT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data")
+sys.path.append(EXTRACT_PATH)
+
+from bea_metrics import metrics
+from bea_stub_server import bea_stub_server
+from bea_async import bea_api, bea_retry_error, rate_limiter
+
+# the stub accepts any key
+STUB_KEY = "00000000-0000-0000-0000-000000000000"
+metrics.configure(os.devnull)
+
+
+class flaky_stub(bea_stub_server):
+    """
+    Stub answering the first failures GetData requests with 503, and recording when each request arrived.
+    """
+    def __init__(self, failures=0, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.arrivals = []
+
+    async def handle(self, request):
+        self.arrivals.append(time.monotonic())
+        if len(self.arrivals) <= self.failures:
+            self.requests += 1
+            return web.Response(status=503)
+        return await super().handle(request)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fetch(stub, line_codes=("10",), table="SAINC30", **kwargs):
+    """
+    Serve the stub and request each line code through bea_api, returning the frames and the client.
+    """
+    async def run():
+        runner, url = await stub.start(port=free_port())
+        api = bea_api(STUB_KEY, base_url=url, **kwargs)
+        api.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                results = await asyncio.gather(*(api.get_state_linecodes(session, table, code) for code in line_codes))
+        finally:
+            await runner.cleanup()
+        return [df for df, changed in results], api
+    return asyncio.run(run())
+
+
+def test_fixture_served():
+    (df,), api = fetch(bea_stub_server())
+    assert set(df.GeoFips) == {"00000", "01000", "48000"}
+    assert df.loc[(df.GeoFips == "01000") & (df.TimePeriod == "2019"), "DataValue"].item() == 222563
+    # suppressed values come back missing
+    assert df.loc[(df.GeoFips == "48000") & (df.TimePeriod == "2020"), "DataValue"].isna().all()
+
+
+def test_retry_backoff():
+    stub = flaky_stub(failures=2)
+    start = time.monotonic()
+    (df,), api = fetch(stub, max_retries=3, backoff=0.1)
+    assert len(df) == 9
+    assert stub.requests == 3
+    # waits of at least backoff * 2 ** attempt between attempts
+    assert stub.arrivals[1] - stub.arrivals[0] >= 0.1
+    assert stub.arrivals[2] - stub.arrivals[1] >= 0.2
+    assert time.monotonic() - start >= 0.3
+
+
+def test_retries_exhausted():
+    stub = flaky_stub(failures=10)
+    with pytest.raises(bea_retry_error):
+        fetch(stub, max_retries=2, backoff=0.01)
+    assert stub.requests == 3
+
+
+def test_rate_limiter_spacing():
+    # 600 a minute is one request every 0.1s once the burst allowance is spent
+    limiter = rate_limiter(requests_per_minute=600)
+    limiter.tokens["requests"] = 0
+    stub = flaky_stub()
+    fetch(stub, line_codes=[str(code) for code in range(10, 16)], limiter=limiter)
+    assert stub.requests == 6
+    arrivals = sorted(stub.arrivals)
+    per_second = (len(arrivals) - 1) / (arrivals[-1] - arrivals[0])
+    # a little slack for timer resolution
+    assert per_second <= 10 * 1.05
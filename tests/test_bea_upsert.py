@@ -0,0 +1,45 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+from conftest import TRANSFORM_PATH, stub_batch
+from bea_stub_server import bea_stub_server
+from bea_db_load import db_load
+
+
+@pytest.fixture
+def load(tmp_path, monkeypatch):
+    # schema and quality rules are read relative to transform_load_data, like the scripts
+    monkeypatch.chdir(TRANSFORM_PATH)
+    load = db_load(db_path=str(tmp_path / "bea.db"), export_format="none", quality_report=None)
+    load.bea_prep.data_path = str(tmp_path)
+    return load
+
+
+def test_merge_is_idempotent(serve, tmp_path, load):
+    batch = stub_batch(serve(bea_stub_server(fixture_path=str(tmp_path), years=range(2019, 2023))), load)
+    con = load.connect()
+    assert load.merge(con, "personal_income", batch) == batch.num_rows
+    assert load.merge(con, "personal_income", batch) == 0
+    assert con.execute("select count(*) from personal_income").fetchone()[0] == batch.num_rows
+    con.close()
+
+
+def test_merge_writes_only_revisions(serve, tmp_path, load):
+    batch = stub_batch(serve(bea_stub_server(fixture_path=str(tmp_path), years=range(2019, 2023))), load)
+    con = load.connect()
+    load.merge(con, "personal_income", batch)
+    con.execute("delete from load_changes")
+    revised = pc.if_else(pc.equal(batch["timeperiod"], 2022), pc.multiply(batch["datavalue"], 1.01), batch["datavalue"])
+    batch = batch.set_column(batch.column_names.index("datavalue"), "datavalue", revised)
+    rows = load.merge(con, "personal_income", batch)
+    assert rows == pc.sum(pc.equal(batch["timeperiod"], 2022)).as_py()
+    assert con.execute("select distinct timeperiod from load_changes").fetchall() == [(2022,)]
+    con.close()
+
+
+def test_merge_deduplicates_batch(serve, tmp_path, load):
+    batch = stub_batch(serve(bea_stub_server(fixture_path=str(tmp_path), years=range(2019, 2023))), load)
+    con = load.connect()
+    assert load.merge(con, "personal_income", pa.concat_tables([batch, batch])) == batch.num_rows
+    con.close()
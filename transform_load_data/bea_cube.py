@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data"))
+from bea_geography import geography
+from bea_metrics import metrics
+
+CUBE_TABLE = "metrics_cube"
+# CAINC1 line 2, the denominator of every per capita measure
+POPULATION_CODE = "CAINC1-2"
+# industry tables, where line 1 is the all industry total the other lines are shares of
+INDUSTRY_TABLES = ("compensation", "gdp", "real_gdp")
+# series that can be summed across states: levels, not per capita, averages, percents, indexes or chained dollars
+ADDITIVE = """topic not ilike 'per capita%' and topic not ilike 'average%'
+              and coalesce(cl_unit, '') not ilike '%percent%' and coalesce(cl_unit, '') not ilike '%index%'
+              and coalesce(cl_unit, '') not ilike '%chained%'"""
+
+
+class bea_cube():
+    """
+    Derived metrics precomputed over a (geography x year x series) grid and stored in one table, metrics_cube.
+    Every US + state row of the fact tables, plus BEA region rollups (and a national one where BEA published none) of
+    additive series, carries its per capita value, industry share, year over year change and 5 and 10 year CAGR.
+    Built as one DuckDB query, columnar and vectorized across its threads, and sorted by (table_name, code, geofips, year)
+    so a slice such as one series across states and years reads a few row groups and needs no joins or windows.
+    """
+    def __init__(self, con):
+        """
+        con = DuckDB connection with the loaded tables
+        """
+        self.con = con
+
+    def fact_tables(self):
+        return sorted(table for (table,) in self.con.execute(
+            "select table_name from duckdb_columns where column_name = 'datavalue' and table_name != ?", [CUBE_TABLE]).fetchall())
+
+    def exists(self):
+        return self.con.execute("select count(*) from duckdb_tables where table_name = ?", [CUBE_TABLE]).fetchone()[0] > 0
+
+    def query(self, tables):
+        facts = " union all ".join(f"select '{table}' as table_name, code, geofips, timeperiod as year, datavalue from {table}"
+                                   for table in tables)
+        industry_tables = ", ".join(f"'{table}'" for table in INDUSTRY_TABLES)
+        return f"""
+            with facts as ({facts}),
+
+            -- US + states, counties and anything else outside the bundled reference drop out here
+            published as (
+                select facts.*, regions.level, regions.region_fips
+                from facts
+                join regions using (geofips)
+                where regions.level in ('nation', 'state')),
+
+            region_states as (
+                select region_fips, count(*) as states from regions where level = 'state' group by region_fips),
+
+            additive as (
+                select published.*
+                from published
+                join series using (code)
+                where published.level = 'state' and {ADDITIVE}),
+
+            -- a region is only summed when all of its states are there
+            region_rollup as (
+                select table_name, code, region_fips as geofips, year, sum(datavalue) as datavalue, 'region' as level, region_fips
+                from additive
+                group by table_name, code, region_fips, year
+                having count(*) = (select states from region_states where region_states.region_fips = additive.region_fips)),
+
+            nation_rollup as (
+                select table_name, code, '00000' as geofips, year, sum(datavalue) as datavalue, 'nation' as level, null as region_fips
+                from additive
+                group by table_name, code, year
+                having count(*) = (select sum(states) from region_states)
+                    and not exists (select 1 from published
+                                    where published.level = 'nation' and published.table_name = additive.table_name
+                                        and published.code = additive.code and published.year = additive.year)),
+
+            grid as (
+                select * from published
+                union all by name
+                select * from region_rollup
+                union all by name
+                select * from nation_rollup),
+
+            population as (
+                select geofips, year, datavalue * power(10, series.unit_mult) as population
+                from grid
+                join series using (code)
+                where code = '{POPULATION_CODE}' and table_name = 'population')
+
+            select
+                grid.table_name,
+                grid.code,
+                series.topic,
+                series.cl_unit as unit,
+                series.unit_mult,
+                grid.level,
+                region.geoname as region,
+                grid.geofips,
+                regions.geoname,
+                grid.year,
+                grid.datavalue as value,
+                case when series.topic not ilike 'per capita%' and grid.code != '{POPULATION_CODE}'
+                    then grid.datavalue * power(10, series.unit_mult) / nullif(population.population, 0) end as per_capita,
+                case when grid.table_name in ({industry_tables})
+                    then grid.datavalue / nullif(max(grid.datavalue) filter (where series.endpoint = '1') over total, 0) end as industry_share,
+                case when lag(grid.year) over history = grid.year - 1
+                    then grid.datavalue - lag(grid.datavalue) over history end as yoy_change,
+                case when lag(grid.year) over history = grid.year - 1
+                    then 100 * (grid.datavalue - lag(grid.datavalue) over history) / nullif(lag(grid.datavalue) over history, 0) end as yoy_pct,
+                case when lag(grid.year, 5) over history = grid.year - 5 and grid.datavalue > 0 and lag(grid.datavalue, 5) over history > 0
+                    then 100 * (pow(grid.datavalue / lag(grid.datavalue, 5) over history, 1 / 5) - 1) end as cagr_5y,
+                case when lag(grid.year, 10) over history = grid.year - 10 and grid.datavalue > 0 and lag(grid.datavalue, 10) over history > 0
+                    then 100 * (pow(grid.datavalue / lag(grid.datavalue, 10) over history, 1 / 10) - 1) end as cagr_10y
+            from grid
+            join series using (code)
+            join regions using (geofips)
+            left join regions region on region.geofips = grid.region_fips
+            left join population using (geofips, year)
+            window history as (partition by grid.table_name, grid.code, grid.geofips order by grid.year),
+                total as (partition by grid.table_name, series."table", grid.geofips, grid.year)
+            order by grid.table_name, grid.code, grid.geofips, grid.year
+                 """
+
+    def build(self):
+        """
+        Rebuild metrics_cube from every fact table. Returns the number of rows.
+        """
+        start = time.perf_counter()
+        tables = self.fact_tables()
+        if not tables:
+            return 0
+        regions = geography()[["geofips", "geoname", "level", "region_fips"]]
+        self.con.register("regions", regions)
+        try:
+            self.con.execute(f"create or replace table {CUBE_TABLE} as {self.query(tables)}")
+        finally:
+            self.con.unregister("regions")
+        rows = self.con.execute(f"select count(*) from {CUBE_TABLE}").fetchone()[0]
+        metrics.event("cube_built", table=CUBE_TABLE, tables=len(tables), rows=rows, seconds=round(time.perf_counter() - start, 4))
+        return rows
+
+    def refresh(self, changed_tables):
+        """
+        Rebuild metrics_cube when a table changed this run, or when there is none yet
+        """
+        if changed_tables or not self.exists():
+            return self.build()
+        return 0
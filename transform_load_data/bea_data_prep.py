@@ -1,91 +1,216 @@
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import os
-import re
+import sys
 import json
-from collections import defaultdict
+import time
+import shutil
+import tempfile
+import resource
 import multiprocessing as mp
-from collections import ChainMap
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data"))
+from bea_staging import bea_staging
+from bea_catalog import bea_catalog
+from bea_metrics import metrics, peak_rss_mb
 
 pd.options.mode.chained_assignment = None  
 
+# typed rows for the fact tables in inputs/schema.sql. geoname goes to the geography dimension table,
+# cl_unit + unit_mult (the power of ten datavalue is scaled by) to the series dimension table
+TABLE_SCHEMA = pa.schema([("code", pa.string()),
+                          ("geofips", pa.string()),
+                          ("geoname", pa.string()),
+                          ("timeperiod", pa.int32()),
+                          ("cl_unit", pa.string()),
+                          ("unit_mult", pa.int16()),
+                          ("datavalue", pa.float64()),
+                          ("noteref", pa.string())])
+
+worker_prep = None
+
+
+def init_worker(staging_format, data_path, batch_size):
+    """
+    Pool initializer: each worker reads the line code catalog and builds its lookups once, instead of receiving them pickled per task
+    """
+    global worker_prep
+    worker_prep = bea_data_prep(staging_format, data_path, batch_size)
+
+
+def transform_worker(table, output_path):
+    """
+    Transform one staged table and hand it back as an uncompressed Arrow IPC file rather than a pickled pa.Table.
+    With a batch_size the table is transformed and written a record batch at a time.
+    """
+    start = time.perf_counter()
+    path = os.path.join(output_path, f"{table}.arrow")
+    if worker_prep.batch_size is None:
+        data = worker_prep.clean_staged_table(table)[table]
+        feather.write_feather(data, path, compression="uncompressed")
+    else:
+        writer = None
+        for batch in worker_prep.clean_staged_batches(table):
+            if writer is None:
+                writer = ipc.new_file(path, batch.schema)
+            writer.write_table(batch)
+        if writer is None:
+            feather.write_feather(worker_prep.clean_staged_table(table)[table], path, compression="uncompressed")
+        else:
+            writer.close()
+    return table, path, time.perf_counter() - start, peak_rss_mb(), os.getpid()
+
+
 class bea_data_prep():
-    def __init__(self):
-        self.data_path = "../extract_data/data"
-        self.endpoints_df = self.endpoints_file()
-
-    def find_json_paths(self):
-        path_dict = {}
-        for file in os.listdir(self.data_path):
-            if ".json" in file:
-                path = os.path.join(self.data_path, file)
-                table = re.search("(_data\\/data\\/)(.*)(?=\\.json)", path).group(2)
-                path_dict[table] = path
-        return path_dict
-
-    def clean_json_files(self, table, path):
+    def __init__(self, staging_format="parquet", data_path="../extract_data/data", batch_size=None):
+        """
+        batch_size = transform staged tables this many rows at a time (out of core, for county data), None for whole tables
+        """
+        self.data_path = data_path
+        self.staging_format = staging_format
+        self.batch_size = batch_size
+        self.staging = bea_staging(self.data_path, staging_format)
+        self.endpoints_df = None
+        self.lookups = {}
+        self.alias_map = None
+
+    def changed_tables(self):
+        """
+        Tables rewritten by the last extract run, from the manifest written by bea_data_clean.file_save_threads
+        """
+        manifest = os.path.join(self.data_path, "changed.json")
+        if not os.path.exists(manifest):
+            return None
+        with open(manifest, "r") as f:
+            return set(json.load(f))
+
+    def consume_changes(self, tables):
+        """
+        Drop loaded tables from the changed.json manifest, the rest carry over to the next --changed-only load
+        """
+        manifest = os.path.join(self.data_path, "changed.json")
+        if not os.path.exists(manifest):
+            return
+        with open(manifest, "r") as f:
+            changed = json.load(f)
+        with open(manifest, "w") as outfile:
+            json.dump({table: codes for table, codes in changed.items() if table not in tables}, outfile, indent=2)
+
+    def aliases(self):
+        """
+        {alias: {alias_of, table, source_table}} of line codes stored under another table's line code, from the manifest
+        written by bea_data_clean.write_manifests. None when the extract run predates it.
+        """
+        if self.alias_map is None:
+            manifest = os.path.join(self.data_path, "aliases.json")
+            if not os.path.exists(manifest):
+                return None
+            with open(manifest, "r") as f:
+                self.alias_map = json.load(f)
+        return self.alias_map
+
+    def find_staged_tables(self, changed_only=False):
+        changed = self.changed_tables() if changed_only else None
+        return tuple(table for table in self.staging.tables() if changed is None or table in changed)
+
+    def clean_staged_table(self, table):
         data_dict = {}
-        data_df = self.bea_dataframe(path)
-        clean_endpoints_df = self.clean_endpoints(data_df)
-        description_df = self.table_description(table, clean_endpoints_df)
-        endpoints_description_df = clean_endpoints_df.merge(description_df[["endpoint", "table", "topic"]], 
-                                                            how="inner", 
-                                                            on = ["table", "endpoint"]).drop_duplicates().reset_index(drop=True)
-        data_endpoints_df = data_df.merge(endpoints_description_df, how="inner", on="code")
-        data_endpoints_table = pa.Table.from_pandas(data_endpoints_df)
-        data_dict[table] = data_endpoints_table
+        data = self.bea_table(self.staging.read(table))
+        data_dict[table] = self.clean_table(table, data)
         return data_dict
+
+    def clean_staged_batches(self, table):
+        """
+        clean_staged_table one staged record batch at a time
+        """
+        for batch in self.staging.batches(table, self.batch_size):
+            yield self.clean_table(table, self.bea_table(pa.Table.from_batches([batch])))
+
+    def clean_table(self, table, data):
+        """
+        Keep the rows of known endpoints. Their (table, endpoint, topic) descriptions stay in endpoint_lookup,
+        which db_load writes once per series instead of repeating them on every row.
+        Aliases, staged by extract runs from before they were fetched once, are dropped.
+        """
+        codes = self.endpoint_lookup(table)["code"]
+        if self.aliases():
+            codes = codes.filter(pc.invert(pc.is_in(codes, value_set=pa.array(list(self.aliases()), pa.string()))))
+        return data.filter(pc.is_in(data["code"], value_set=codes))
     
     def endpoints_file(self):
-        endpoints = pd.read_csv("inputs/endpoints.csv", dtype="str")
+        # the same catalog bea_api requests line codes from, see bea_catalog
+        endpoints = bea_catalog().load().copy()
         endpoints.rename({"Key": "endpoint", "Desc": "desc"}, axis=1, inplace=True)
         return endpoints
     
-    def bea_dataframe(self, path):
-        json_file = open(path, "r")
-        json_data = json.load(json_file)
-        json_dict = json.loads(json_data)
-        json_df = pd.DataFrame.from_dict(json_dict)
-        json_df["GeoName"] = json_df["GeoName"].apply(lambda x: "United States" if x == "United States *" else x)
-        json_df.columns =  map(str.lower, json_df.columns)
-        return json_df
-    
-    def clean_endpoints(self, df):
-        code_dict = defaultdict(lambda: defaultdict(str))
-        for code in df.code.unique():
-            code_components = code.split("-")
-            code_dict[code]["table"] = code_components[0]
-            code_dict[code]["endpoint"] = code_components[1]
-        return pd.DataFrame(code_dict).T.reset_index(names="code")
-    
-    def table_description(self, table, description_df):
+    def bea_table(self, data):
+        """
+        Lower case column names, cast to TABLE_SCHEMA (timeperiod an integer year) and drop the country level marker from United States *
+        """
+        data = data.rename_columns([column.lower() for column in data.column_names])
+        if "noteref" not in data.column_names:
+            data = data.append_column("noteref", pa.nulls(data.num_rows, pa.string()))
+        data = data.select(TABLE_SCHEMA.names).cast(TABLE_SCHEMA)
+        geoname = pc.if_else(pc.equal(data["geoname"], "United States *"), "United States", data["geoname"])
+        return data.set_column(data.column_names.index("geoname"), "geoname", geoname)
+
+    def endpoint_lookup(self, table):
+        """
+        (code, table, endpoint, topic) for every endpoint, built once per table description rule
+        """
         endpoint_re_map = {
-            "compensation": (["Compensation of employees: ", " \(\d.+\)$"], ["", ""]),
-            "real_gdp": (["Real GDP: ", " \(\d.+\)$"], ["", ""]),
-            "gdp": (["Gross domestic product \(GDP\) by state\: ",  " \(\d.+\)$"], ["", ""]),
-            "consumption_expenditure": (["Per capita personal consumption expenditures: "], ["", ""])
+            "compensation": ("Compensation of employees: ", r" \(\d.+\)$"),
+            "real_gdp": ("Real GDP: ", r" \(\d.+\)$"),
+            "gdp": (r"Gross domestic product \(GDP\) by state\: ", r" \(\d.+\)$"),
+            "consumption_expenditure": ("Per capita personal consumption expenditures: ",)
         }
-        if table in endpoint_re_map:
-            endpoint_re = endpoint_re_map[table]
-            endpoints_description = self.endpoints_df [self.endpoints_df.table.isin(description_df.table.unique())]
-            endpoints_description["topic"] = endpoints_description.desc.replace(endpoint_re[0], endpoint_re[1], regex=True)
-            return endpoints_description
-        else:
-            endpoints_description = self.endpoints_df [self.endpoints_df.table.isin(description_df.table.unique())]
-            endpoints_description["topic"] = endpoints_description["desc"]
-            return endpoints_description
+        rule = table if table in endpoint_re_map else None
+        if rule not in self.lookups:
+            if self.endpoints_df is None:
+                self.endpoints_df = self.endpoints_file()
+            endpoints = pa.Table.from_pandas(self.endpoints_df, preserve_index=False)
+            topic = endpoints["desc"].cast(pa.string())
+            for pattern in endpoint_re_map.get(rule, ()):
+                topic = pc.replace_substring_regex(topic, pattern, "")
+            code = pc.binary_join_element_wise(endpoints["table"].cast(pa.string()), endpoints["endpoint"].cast(pa.string()), "-")
+            lookup = pa.table({"code": code,
+                               "table": endpoints["table"].cast(pa.string()),
+                               "endpoint": endpoints["endpoint"].cast(pa.string()),
+                               "topic": topic})
+            self.lookups[rule] = lookup.group_by(["code", "table", "endpoint", "topic"]).aggregate([])
+        return self.lookups[rule]
         
-    def transform(self):
-        bea_prep = bea_data_prep()
-        print("Loading JSON data")
-        path_dict = bea_prep.find_json_paths()
-        path_args = tuple(map(tuple, path_dict.items()))
-
-        print("Pooling data transformation")
-        pool = mp.Pool(processes=4)
-        results = pool.starmap(bea_prep.clean_json_files, path_args)
-        print("Data transformation complete")
-        print()
-
-        arrow_dict = dict(ChainMap(*results))
-        return arrow_dict
\ No newline at end of file
+    def transform(self, changed_only=False):
+        """
+        Transform staged tables in a process pool sized to the number of tables and cores.
+        Results come back through Arrow IPC files in shared memory (/dev/shm when available) and are memory mapped.
+        Batched (out of core) runs keep those files on disk instead, since /dev/shm counts against RAM.
+        """
+        tables = self.find_staged_tables(changed_only)
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        processes = max(1, min(len(tables), cores))
+
+        shared_memory = self.batch_size is None and os.path.isdir("/dev/shm")
+        output_path = tempfile.mkdtemp(prefix="bea_transform_", dir="/dev/shm" if shared_memory else self.data_path)
+        arrow_dict = {}
+        self.transform_stats = {}
+        with metrics.stage("transform", staging_format=self.staging_format):
+            try:
+                with mp.Pool(processes=processes, initializer=init_worker, initargs=(self.staging_format, self.data_path, self.batch_size)) as pool:
+                    for table, path, seconds, worker_rss, pid in pool.starmap(transform_worker, ((table, output_path) for table in tables)):
+                        arrow_dict[table] = feather.read_table(path, memory_map=True)
+                        self.transform_stats[table] = {"seconds": seconds, "worker_peak_rss_mb": worker_rss}
+                        metrics.observe("bea_transform_seconds", seconds, table=table)
+                        metrics.gauge("bea_transform_rows", arrow_dict[table].num_rows, table=table)
+                        metrics.event("transformed", table=table, rows=arrow_dict[table].num_rows, seconds=round(seconds, 4),
+                                      worker=pid, worker_peak_rss_mb=round(worker_rss, 1))
+            finally:
+                # mapped tables stay readable after their files are unlinked
+                shutil.rmtree(output_path, ignore_errors=True)
+        metrics.gauge("bea_transform_worker_peak_rss_mb", peak_rss_mb(resource.RUSAGE_CHILDREN))
+        metrics.event("transform_pool", processes=processes, tables=len(tables),
+                      largest_worker_peak_rss_mb=round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1))
+        return arrow_dict
@@ -1,70 +1,441 @@
+import os
+import json
+import time
+import shutil
+import pyarrow as pa
+from datetime import datetime, timezone
 import bea_data_prep as prep
+from bea_metrics import metrics
+from bea_quality import bea_quality, bea_quality_error
 import duckdb as db
 import bea_views as beav
+from bea_cube import bea_cube, CUBE_TABLE
+
+SCHEMA_PATH = "inputs/schema.sql"
+KEY_COLUMNS = ("code", "geofips", "timeperiod")
+QUALITY_REPORT_PATH = "quality_report.json"
+EXPORT_PATH = "db"
+MANIFEST_PATH = os.path.join(EXPORT_PATH, "manifest.json")
+# Hive partition column of each exported table, fact tables default to timeperiod and the dimension tables are one file each.
+# series_alias maps the aliased series, whose rows are only stored under their source table's code
+PARTITION_COLUMNS = {CUBE_TABLE: "year", "geography": None, "series": None, "series_alias": None}
 
 class db_load():
-    def __init__(self):
-        bea_data = prep.bea_data_prep()
-        self.arrow_dict = bea_data.transform()
-
-    def validate_null(self, table):
-        # code, timeperiod, table, endpoint, topic, geofips, geoname cannot be null
-        query = f"""
-            SELECT count(*) as null_records
-            FROM {table} 
-            WHERE code IS NULL OR 
-                geofips IS NULL OR
-                geoname IS NULL OR
-                timeperiod IS NULL OR
-                'table' IS NULL OR
-                endpoint IS NULL OR
-                topic IS NULL
-                 """
-        return query
-
-    def validate_geo(self, table):
-        # at least 50 unique geofips & 50 unique geoname should exist. Some tables will include United States and/or District of Columbia
-        query = f"""
-            SELECT 
-                count(distinct geofips) as geofips_count,
-                count(distinct geoname) as geoname_count
-            FROM {table} 
-                 """
-        return query
+    def __init__(self, changed_only=False, staging_format="parquet", export_format="parquet", materialize=False,
+                 db_path="bureau_economic_analysis.db", arrow_dict=None, batch_size=None, memory_limit=None,
+                 quality_report=QUALITY_REPORT_PATH, swap=False, full_export=False):
+        """
+        changed_only = only transform and reload tables extract runs rewrote since the last load
+        staging_format = format the extract run staged its tables in, see bea_staging
+        export_format = parquet (Hive partitioned, only partitions that changed), csv (legacy full EXPORT DATABASE) or none
+        materialize = store the analysis views as incrementally refreshed tables, see bea_views
+        db_path = DuckDB database file
+        arrow_dict = already transformed {table: pa.Table} to load instead of running bea_data_prep
+        batch_size = transform and merge tables this many rows at a time (out of core, for county data)
+        memory_limit = DuckDB memory limit such as 4GB, anything over it spills to disk
+        quality_report = where to write the data quality report of the load, None to skip it, see bea_quality
+        swap = load into a copy of the database and rename it over db_path when done, so bea_query readers keep the old file meanwhile
+        full_export = rewrite every Parquet partition instead of only the changed ones
+        """
+        self.db_path = db_path
+        self.export_format = export_format
+        self.materialize = materialize
+        self.batch_size = batch_size
+        self.memory_limit = memory_limit
+        self.quality_report = quality_report
+        self.swap = swap
+        self.full_export = full_export
+        self.changed_only = changed_only
+        # endpoint lookups for the series dimension
+        self.bea_prep = prep.bea_data_prep(staging_format, batch_size=batch_size)
+        self.arrow_dict = arrow_dict
+        self.staged = False
 
-    def duckdb(self):
-        # create DuckDB database
-        con = db.connect("bureau_economic_analysis.db")
+    def transform(self):
+        """
+        Transform the staged tables with bea_data_prep, unless arrow_dict was given. Returns {table: pa.Table}.
+        """
+        if self.arrow_dict is None:
+            self.arrow_dict = self.bea_prep.transform(self.changed_only)
+            # tables transformed from staging files are consumed from changed.json once loaded
+            self.staged = True
+        return self.arrow_dict
+
+    def validate(self, con, tables):
+        """
+        Run the data quality rules over the loaded tables and write the report. Raises bea_quality_error if an error rule fails.
+        """
+        with metrics.stage("validate", tables=len(tables)):
+            report = bea_quality(con).run(tables)
+        if self.quality_report is not None:
+            with open(self.quality_report, "w") as outfile:
+                json.dump(report, outfile, indent=2)
+        if not report["passed"]:
+            raise bea_quality_error(report)
+        return report
+
+    def configure(self, con):
+        """
+        Let large loads spill to a temp directory next to the database instead of failing at the memory limit
+        """
+        con.execute(f"SET temp_directory = '{self.db_path}.tmp'")
+        con.execute("SET preserve_insertion_order = false")
+        if self.memory_limit is not None:
+            con.execute(f"SET memory_limit = '{self.memory_limit}'")
+
+    def merge(self, con, table_name, data):
+        """
+        upsert a table whole, or a record batch at a time when batch_size is set, then prune the geographies it no longer has
+        """
+        if self.batch_size is None:
+            rows = self.upsert(con, table_name, data)
+        else:
+            rows = sum(self.upsert(con, table_name, batch) for batch in data.to_batches(max_chunksize=self.batch_size))
+        return rows + self.prune_geographies(con, table_name, data)
+
+    def prune_geographies(self, con, table_name, data):
+        """
+        Delete rows of geofips missing from a table's full staged data, e.g. county rows once a STATE run restaged a table
+        loaded from a COUNTY run. Returns the number of rows deleted.
+        """
+        if data.num_rows == 0:
+            return 0
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE stale AS
+            SELECT DISTINCT geofips, timeperiod FROM {table_name}
+            WHERE geofips NOT IN (SELECT DISTINCT geofips FROM data)
+                    """)
+        rows = con.execute(f"DELETE FROM {table_name} WHERE geofips IN (SELECT geofips FROM stale)").fetchone()[0]
+        if rows > 0:
+            # the emptied (geography, year) partitions are refreshed by bea_views and dropped from the export
+            con.execute(f"INSERT INTO load_changes SELECT '{table_name}', geofips, timeperiod FROM stale")
+        con.execute("DROP TABLE stale")
+        return rows
+
+    def create_tables(self, con):
+        """
+        Tables are defined in inputs/schema.sql: typed fact tables with a primary key on (code, geofips, timeperiod),
+        plus the geography and series dimension tables their codes and geofips refer to
+        """
+        wide = con.execute("select distinct table_name from duckdb_columns where column_name = 'geoname' and table_name not in (?, ?)",
+                           ["geography", CUBE_TABLE]).fetchall()
+        if wide:
+            raise ValueError(f"{self.db_path} has tables from before the typed schema ({', '.join(sorted(name for name, in wide))}), "
+                             "rebuild it by deleting the file and loading again")
+        with open(SCHEMA_PATH, "r") as schema:
+            con.execute(schema.read())
+
+    def upsert_dimensions(self, con, table_name, data):
+        """
+        Write the geonames and series (table, endpoint, topic, unit) of data that are new or changed
+        """
+        lookup = self.bea_prep.endpoint_lookup(table_name)
+        con.execute("""
+            INSERT OR REPLACE INTO geography
+            SELECT new.geofips, new.geoname
+            FROM (SELECT geofips, max(geoname) AS geoname FROM data GROUP BY geofips) new
+            LEFT JOIN geography current USING (geofips)
+            WHERE current.geoname IS DISTINCT FROM new.geoname
+                    """)
+        con.execute("""
+            INSERT OR REPLACE INTO series
+            SELECT new.*
+            FROM (
+                SELECT lookup.code, lookup."table", lookup.endpoint, lookup.topic, units.cl_unit, units.unit_mult
+                FROM lookup
+                JOIN (SELECT code, max(cl_unit) AS cl_unit, max(unit_mult) AS unit_mult FROM data GROUP BY code) units USING (code)
+                QUALIFY row_number() OVER (PARTITION BY lookup.code ORDER BY lookup.topic) = 1) new
+            LEFT JOIN series current USING (code)
+            WHERE current.code IS NULL OR
+                (new."table", new.endpoint, new.topic, new.cl_unit, new.unit_mult) IS DISTINCT FROM
+                (current."table", current.endpoint, current.topic, current.cl_unit, current.unit_mult)
+                    """)
+
+    def upsert_aliases(self, con, aliases):
+        """
+        Replace series_alias with aliases (see bea_api.series_aliases) and give every alias a series row of its own, with the
+        units of the series it repeats, so bea_views reads it from the source table under its own code and topic.
+        Rows loaded under an alias code by earlier runs are deleted. Returns whether the aliases changed.
+        """
+        if aliases is None:
+            return False
+        new = pa.table({"code": pa.array(list(aliases), pa.string()),
+                        "table_name": pa.array([alias["table"] for alias in aliases.values()], pa.string()),
+                        "alias_of": pa.array([alias["alias_of"] for alias in aliases.values()], pa.string()),
+                        "source_table": pa.array([alias["source_table"] for alias in aliases.values()], pa.string())})
+        changed = con.execute("""
+            SELECT count(*) FROM (
+                (SELECT * FROM new EXCEPT SELECT * FROM series_alias)
+                UNION ALL
+                (SELECT * FROM series_alias EXCEPT SELECT * FROM new))
+                              """).fetchone()[0] > 0
+        if changed:
+            con.execute("DELETE FROM series_alias")
+            con.execute("INSERT INTO series_alias SELECT * FROM new")
+        for table_name in sorted(set(new["table_name"].to_pylist())):
+            lookup = self.bea_prep.endpoint_lookup(table_name)
+            con.execute(f"""
+                INSERT OR REPLACE INTO series
+                SELECT new.*
+                FROM (
+                    SELECT lookup.code, lookup."table", lookup.endpoint, lookup.topic, source.cl_unit, source.unit_mult
+                    FROM series_alias
+                    JOIN lookup USING (code)
+                    JOIN series source ON source.code = series_alias.alias_of
+                    WHERE series_alias.table_name = '{table_name}'
+                    QUALIFY row_number() OVER (PARTITION BY lookup.code ORDER BY lookup.topic) = 1) new
+                LEFT JOIN series current USING (code)
+                WHERE current.code IS NULL OR
+                    (new."table", new.endpoint, new.topic, new.cl_unit, new.unit_mult) IS DISTINCT FROM
+                    (current."table", current.endpoint, current.topic, current.cl_unit, current.unit_mult)
+                        """)
+            aliased = f"code IN (SELECT code FROM series_alias WHERE table_name = '{table_name}')"
+            con.execute(f"INSERT INTO load_changes SELECT DISTINCT '{table_name}', geofips, timeperiod FROM {table_name} WHERE {aliased}")
+            rows = con.execute(f"DELETE FROM {table_name} WHERE {aliased}").fetchone()[0]
+            if rows > 0:
+                metrics.event("aliases_deduplicated", table=table_name, rows=rows)
+        metrics.event("series_aliases", aliases=len(aliases), changed=changed)
+        return changed
+
+    def upsert(self, con, table_name, data):
+        """
+        Merge new or revised rows of data into table_name, leaving unchanged rows untouched.
+        Returns the number of rows written.
+        """
+        self.upsert_dimensions(con, table_name, data)
+        columns = [column for column in con.table(table_name).columns if column in data.column_names]
+        quoted = ", ".join(f'"{column}"' for column in columns)
+        keys = ", ".join(f"data.{key}" for key in KEY_COLUMNS)
+        revised = " OR ".join(f'data."{column}" IS DISTINCT FROM current."{column}"' for column in columns if column not in KEY_COLUMNS)
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE delta AS
+            SELECT {", ".join(f'data."{column}"' for column in columns)}
+            FROM data
+            LEFT JOIN {table_name} current USING ({", ".join(KEY_COLUMNS)})
+            WHERE current.code IS NULL OR {revised}
+            QUALIFY row_number() OVER (PARTITION BY {keys}) = 1
+                    """)
+        rows = con.execute("SELECT count(*) FROM delta").fetchone()[0]
+        if rows > 0:
+            con.execute(f"INSERT OR REPLACE INTO {table_name} ({quoted}) SELECT {quoted} FROM delta")
+            # (geography, year) partitions for bea_views to refresh
+            con.execute(f"INSERT INTO load_changes SELECT DISTINCT '{table_name}', geofips, timeperiod FROM delta")
+        con.execute("DROP TABLE delta")
+        return rows
+
+    def record_load(self, table_name, rows_in, rows, seconds):
+        metrics.observe("bea_load_seconds", seconds, table=table_name)
+        metrics.inc("bea_load_rows_total", rows, table=table_name)
+        metrics.event("loaded", table=table_name, rows_in=rows_in, rows_merged=rows, seconds=round(seconds, 4), database=self.db_path)
+
+    def changed_partitions(self, con):
+        """
+        {table: {timeperiod}} merged by this load, read before bea_views clears load_changes
+        """
+        changes = {}
+        for table_name, timeperiod in con.execute("SELECT DISTINCT table_name, timeperiod FROM load_changes").fetchall():
+            changes.setdefault(table_name, set()).add(timeperiod)
+        return changes
+
+    def read_manifest(self):
+        if self.full_export or not os.path.exists(MANIFEST_PATH):
+            return {"format": "parquet", "partitioning": "hive", "compression": "zstd", "tables": {}}
+        with open(MANIFEST_PATH, "r") as f:
+            return json.load(f)
 
-        # create table
-        for table_name, data in self.arrow_dict.items():
-            con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM data")
-            print(f"Created table {table_name} in bureau_economic_analysis database")
-            print(f"Schema for {table_name}")
-            query = f"SHOW {table_name}"
-            print(con.sql(query))
-            print(f"Validate null values don't exist in code, geofips, geoname, timeperiod, table, endpoint, topic columns")
+    def export_table(self, con, table_name, partitions=None):
+        """
+        Write table_name as Parquet under db/{table_name}, Hive partitioned by its PARTITION_COLUMNS column and sorted by
+        code + geofips, so row group statistics prune on code, geofips and year. Only the given partition values are
+        rewritten, all of them when None. They are written beside the export and renamed into place, and those left
+        without rows (e.g. moved to an alias by upsert_aliases) are deleted.
+        Returns the table's manifest entry holding the rewritten partitions.
+        """
+        path = os.path.join(EXPORT_PATH, table_name)
+        staging = f"{path}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        column = PARTITION_COLUMNS.get(table_name, "timeperiod")
+        relation = con.table(table_name)
+        order = " ORDER BY code, geofips" if {"code", "geofips"} <= set(relation.columns) else ""
+        if column is None:
+            os.makedirs(staging)
+            con.execute(f"COPY (SELECT * FROM {table_name}{order}) TO '{staging}/data_0.parquet' (FORMAT parquet, COMPRESSION zstd)")
+            written, partitions = [""], None
+        else:
+            where = "" if partitions is None else f" WHERE {column} IN ({', '.join(str(int(value)) for value in sorted(partitions))})"
+            con.execute(f"COPY (SELECT * FROM {table_name}{where}{order}) TO '{staging}' (FORMAT parquet, COMPRESSION zstd, PARTITION_BY ({column}))")
+            written = sorted(os.listdir(staging))
+        if partitions is None:
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(staging, path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for partition in written:
+                shutil.rmtree(os.path.join(path, partition), ignore_errors=True)
+                os.replace(os.path.join(staging, partition), os.path.join(path, partition))
+            for value in partitions:
+                if f"{column}={int(value)}" not in written:
+                    shutil.rmtree(os.path.join(path, f"{column}={int(value)}"), ignore_errors=True)
+            shutil.rmtree(staging)
+        # the single file of earlier exports
+        if os.path.exists(f"{path}.parquet"):
+            os.remove(f"{path}.parquet")
 
-            validate_null_query = self.validate_null(table_name)
-            print(con.sql(validate_null_query))
+        exported_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        entry = {"partition_by": column, "columns": dict(zip(relation.columns, map(str, relation.types))), "partitions": {}}
+        files = [os.path.join(path, partition, file_name) for partition in written for file_name in sorted(os.listdir(os.path.join(path, partition)))]
+        for file_name, rows in con.execute("SELECT file_name, num_rows FROM parquet_file_metadata(?)", [files]).fetchall():
+            partition = entry["partitions"].setdefault(os.path.relpath(os.path.dirname(file_name), path).strip("."),
+                                                       {"files": [], "rows": 0, "bytes": 0, "exported_at": exported_at})
+            partition["files"].append(os.path.relpath(file_name, EXPORT_PATH))
+            partition["rows"] += rows
+            partition["bytes"] += os.path.getsize(file_name)
+        metrics.event("exported", table=table_name, path=path, partitions=len(written),
+                      rows=sum(partition["rows"] for partition in entry["partitions"].values()))
+        return entry
 
-            print(f"Validate at least 50 unique geofips & geonames exist")
-            validate_geo_query = self.validate_geo(table_name)
-            print(con.sql(validate_geo_query))
-            print()
+    def export(self, con, changes):
+        """
+        changes = {table: {timeperiod}} merged this run, see changed_partitions
+        Parquet export rewrites only the partitions that changed this run, and the dimension tables and metrics cube whole
+        whenever anything changed, then records every file with its rows and bytes in db/manifest.json.
+        Tables not in the manifest yet are written whole, and full_export rewrites everything. csv re-exports the whole database.
+        """
+        if self.export_format == "parquet":
+            manifest = self.read_manifest()
+            if self.full_export:
+                changes = dict.fromkeys(bea_cube(con).fact_tables())
+            tables = {table_name: partitions if table_name in manifest["tables"] else None for table_name, partitions in changes.items()}
+            if tables:
+                tables.update(dict.fromkeys(PARTITION_COLUMNS))
+            os.makedirs(EXPORT_PATH, exist_ok=True)
+            for table_name, partitions in tables.items():
+                entry = self.export_table(con, table_name, partitions)
+                if partitions is not None:
+                    # requested partitions missing from the entry had no rows left and were deleted
+                    rewritten = {f"{entry['partition_by']}={int(value)}" for value in partitions}
+                    kept = {partition: files for partition, files in manifest["tables"][table_name]["partitions"].items() if partition not in rewritten}
+                    entry["partitions"] = {**kept, **entry["partitions"]}
+                entry["rows"] = sum(partition["rows"] for partition in entry["partitions"].values())
+                entry["bytes"] = sum(partition["bytes"] for partition in entry["partitions"].values())
+                manifest["tables"][table_name] = entry
+            manifest["exported_at"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            with open(f"{MANIFEST_PATH}.tmp", "w") as outfile:
+                json.dump(manifest, outfile, indent=2)
+            os.replace(f"{MANIFEST_PATH}.tmp", MANIFEST_PATH)
+        elif self.export_format == "csv":
+            con.execute("EXPORT DATABASE 'db'")
+
+    def finish(self, con, changed_tables, rebuild_views=False):
+        """
+        changed_tables = tables merged this run
+        rebuild_views = recreate the analysis views in full, when series_alias changed which tables they read
+        """
+        changes = self.changed_partitions(con)
 
         # create views needed for analysis
-        bea_db = beav.bea_views(con)
-        bea_db.views_exist()
-        
-        con.execute("EXPORT DATABASE 'db'")
+        with metrics.stage("views", materialize=self.materialize):
+            bea_db = beav.bea_views(con, self.materialize)
+            bea_db.refresh(rebuild_views)
+
+        # derived metrics (per capita, shares, growth, region rollups) for lookups, see bea_cube
+        with metrics.stage("cube"):
+            bea_cube(con).refresh(sorted(set(changed_tables) | set(changes)))
+
+        with metrics.stage("export", export_format=self.export_format):
+            self.export(con, changes)
 
         con.close()
+        self.publish()
+
+    def connect(self):
+        """
+        Open the database to load, or with swap a copy of it next to db_path
+        """
+        path = self.db_path
+        if self.swap:
+            path = f"{self.db_path}.swap"
+            for suffix in ("", ".wal"):
+                if os.path.exists(self.db_path + suffix):
+                    shutil.copyfile(self.db_path + suffix, path + suffix)
+        con = db.connect(path)
+        self.configure(con)
+        self.create_tables(con)
+        return con
+
+    def publish(self, commit=True):
+        """
+        With swap, rename the loaded copy over db_path in one step, or discard it. Readers of the old file carry on until they reopen.
+        """
+        if not self.swap:
+            return
+        path = f"{self.db_path}.swap"
+        if commit:
+            os.replace(path, self.db_path)
+            # closing the copy checkpointed it, a log left by the old file must not be replayed onto it
+            if os.path.exists(self.db_path + ".wal"):
+                os.remove(self.db_path + ".wal")
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def duckdb(self):
+        self.transform()
+
+        # create DuckDB database
+        con = self.connect()
+
+        # merge new + revised rows in one transaction, committed only if the data quality rules pass
+        changed_tables = []
+        con.begin()
+        try:
+            with metrics.stage("load"):
+                for table_name, data in self.arrow_dict.items():
+                    start = time.perf_counter()
+                    rows = self.merge(con, table_name, data)
+                    self.record_load(table_name, data.num_rows, rows, time.perf_counter() - start)
+                    if rows > 0:
+                        changed_tables.append(table_name)
+                aliases_changed = self.upsert_aliases(con, self.bea_prep.aliases())
+            self.validate(con, list(self.arrow_dict))
+        except BaseException:
+            # a failed merge or check leaves the database, or the file a swap would replace, as it was
+            con.rollback()
+            con.close()
+            self.publish(commit=False)
+            raise
+        con.commit()
+        if self.staged:
+            self.bea_prep.consume_changes(self.arrow_dict)
+
+        self.finish(con, changed_tables, aliases_changed)
 
 if __name__ == "__main__":
-    from datetime import datetime
-    
-    startTime = datetime.now()
-    load = db_load()
-    load.duckdb()
-    print("Run time", datetime.now() - startTime)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Clean and load staged BEA data into DuckDB")
+    parser.add_argument("--changed-only", action="store_true", help="only reload tables rewritten by extract runs since the last load")
+    parser.add_argument("--staging-format", choices=("parquet", "feather", "json"), default="parquet")
+    parser.add_argument("--export-format", choices=("parquet", "csv", "none"), default="parquet")
+    parser.add_argument("--materialize", action="store_true", help="store analysis views as incrementally refreshed tables")
+    parser.add_argument("--batch-size", type=int, help="transform and merge this many rows at a time, for county data")
+    parser.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 4GB. Larger loads spill to disk")
+    parser.add_argument("--full-export", action="store_true", help="rewrite every Parquet partition, not only the changed ones")
+    parser.add_argument("--quality-report", default=QUALITY_REPORT_PATH, help="where to write the data quality report")
+    parser.add_argument("--swap", action="store_true", help="load into a copy of the database and swap it in, for a running bea_query.py")
+    parser.add_argument("--log-file", help="append JSON logs to this file instead of stdout")
+    parser.add_argument("--metrics-file", help="write run metrics in the Prometheus text format to this file")
+    args = parser.parse_args()
+    metrics.configure(args.log_file)
+
+    try:
+        with metrics.stage("transform_load"):
+            load = db_load(args.changed_only, args.staging_format, args.export_format, args.materialize,
+                           batch_size=args.batch_size, memory_limit=args.memory_limit, quality_report=args.quality_report, swap=args.swap,
+                           full_export=args.full_export)
+            load.duckdb()
+    except bea_quality_error as e:
+        metrics.event("load_rejected", error=str(e), report=args.quality_report)
+        raise SystemExit(1)
+    finally:
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
\ No newline at end of file
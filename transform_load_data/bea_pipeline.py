@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import resource
+import tempfile
+import aiohttp
+import pandas as pd
+import pyarrow.feather as feather
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import bea_data_prep as prep
+import bea_views as beav
+from bea_db_load import db_load, QUALITY_REPORT_PATH
+from bea_quality import bea_quality, bea_quality_error
+from bea_cube import bea_cube
+from bea_async import bea_incomplete_error
+from bea_cache import bea_cache, CACHE_PATH
+from bea_staging import DATA_PATH
+from bea_data_json import bea_data_clean
+from bea_tables import TABLE_NAMES, select_tables
+from bea_metrics import metrics, peak_rss_mb
+
+STATE_PATH = "pipeline_state.json"
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def frame_fingerprint(df):
+    return pd.util.hash_pandas_object(df, index=False).values.tobytes()
+
+
+def fetch_fingerprint(data_dict):
+    return fingerprint(*[line_code.encode() + frame_fingerprint(df) for line_code, df in sorted(data_dict.items())])
+
+
+def file_stat(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class bea_pipeline(db_load):
+    """
+    Extract -> load as a task graph with one chain per table of bea_tables: fetch -> state filter + stage -> transform -> load,
+    then each analysis view as soon as the tables it reads are loaded. Chains overlap, so one table transforms in the
+    process pool and loads on the DuckDB writer thread while others are still fetching, and one failing table leaves the
+    rest to finish. A step is skipped when its inputs (fetched data, staged file, catalog rows, aliases) and the table it
+    loads still have the fingerprints of the last successful run, recorded in pipeline_state.json, so refreshing one table
+    (tables=) or rerunning with nothing new at BEA only pays for the fetch, which the response cache keeps conditional.
+    """
+    def __init__(self, key, tables=None, cache_path=CACHE_PATH, incremental=False, revision_window=3, staging_format="parquet",
+                 export_format="parquet", materialize=False, db_path="bureau_economic_analysis.db", geography="STATE", batch_size=None,
+                 memory_limit=None, resume=False, quality_report=QUALITY_REPORT_PATH, swap=False, full_export=False, state_path=STATE_PATH,
+                 force=False):
+        """
+        key = BEA api key
+        tables = BEA codes or table names to run, all of bea_tables.TABLES when None
+        cache_path, incremental, revision_window, staging_format, geography, resume = see bea_data_clean
+        export_format, materialize, db_path, batch_size, memory_limit, quality_report, swap, full_export = see db_load
+        state_path = fingerprints of the last successful run of each table
+        force = run every step, ignoring the recorded fingerprints
+        """
+        super().__init__(staging_format=staging_format, export_format=export_format, materialize=materialize, db_path=db_path,
+                         batch_size=batch_size, memory_limit=memory_limit, quality_report=quality_report, swap=swap, full_export=full_export)
+        self.key = key
+        self.tables = select_tables(tables)
+        self.cache_path = cache_path
+        self.staging_format = staging_format
+        self.geography = geography
+        self.state_path = state_path
+        self.force = force
+        self.bea_clean = bea_data_clean(cache_path, incremental, revision_window, staging_format, geography, resume=resume)
+        self.state = self.read_state()
+        self.aliases_changed = False
+        self.reports = {}
+        self.rejected = {}
+        self.errors = {}
+        self.loaded = set()
+
+    def read_state(self):
+        if self.force or not os.path.exists(self.state_path):
+            return {"tables": {}}
+        with open(self.state_path, "r") as f:
+            return json.load(f)
+
+    def save_state(self):
+        with open(f"{self.state_path}.tmp", "w") as outfile:
+            json.dump(self.state, outfile, indent=2)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def task(self, table, step, status, start=None, **fields):
+        metrics.inc("bea_tasks_total", step=step, status=status)
+        if start is not None:
+            fields["seconds"] = round(time.perf_counter() - start, 4)
+        metrics.event("task", table=table, step=step, status=status, **fields)
+
+    async def write(self, fn, *args):
+        # the connection is only ever used from the one writer thread
+        return await asyncio.get_running_loop().run_in_executor(self.writer, fn, *args)
+
+    def table_fingerprint(self, table_name):
+        rows, digest = self.con.execute(f"select count(*), bit_xor(hash({table_name})) from {table_name}").fetchone()
+        return f"{rows}:{digest}"
+
+    def load_inputs(self, code, table_name, staged):
+        """
+        Everything a table's transform + load reads: its staged file, its catalog rows and the aliases it holds or has
+        """
+        catalog = frame_fingerprint(self.api.catalog.table(code))
+        aliases = {alias: entry for alias, entry in self.aliases.items() if table_name in (entry["table"], entry["source_table"])}
+        return fingerprint(staged, catalog, aliases)
+
+    def load_table(self, table_name, data):
+        """
+        Merge one table in its own transaction with the aliases, committed only if its data quality rules pass.
+        Returns the rows merged and the table's fingerprint.
+        """
+        start = time.perf_counter()
+        self.con.begin()
+        try:
+            rows = self.merge(self.con, table_name, data)
+            aliases_changed = self.upsert_aliases(self.con, self.aliases)
+            report = bea_quality(self.con).run([table_name])
+            if not report["passed"]:
+                raise bea_quality_error(report)
+        except Exception:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        self.aliases_changed |= aliases_changed
+        self.reports[table_name] = report["tables"][table_name]
+        self.record_load(table_name, data.num_rows, rows, time.perf_counter() - start)
+        return rows, self.table_fingerprint(table_name)
+
+    async def run_table(self, code, session):
+        """
+        One table's chain. Returns the rows merged, 0 when its load was up to date, None when it failed.
+        A step raising is logged as failed and only ends this table's chain.
+        """
+        table_name = TABLE_NAMES[code]
+        step = {"name": "fetch"}
+        try:
+            return await self.table_steps(code, table_name, session, step)
+        except Exception as e:
+            self.task(table_name, step["name"], "failed", error=str(e))
+            self.errors[table_name] = f"{step['name']}: {e}"
+            return None
+
+    async def table_steps(self, code, table_name, session, step):
+        """
+        fetch -> stage -> transform -> load for run_table, keeping the running step's name in step
+        """
+        loop = asyncio.get_running_loop()
+        last = self.state["tables"].get(table_name, {})
+
+        start = time.perf_counter()
+        data_dict = await self.api.get_bea_data(code, session)
+        failed = sorted(line_code for line_code, df in data_dict.items() if df is None)
+        if failed:
+            self.task(table_name, "fetch", "failed", start, line_codes=failed)
+            return None
+        fetched = await loop.run_in_executor(None, fetch_fingerprint, data_dict)
+        self.task(table_name, "fetch", "done", start, line_codes=len(data_dict))
+
+        step["name"] = "stage"
+        start = time.perf_counter()
+        staged_path = self.bea_clean.staging.file_path(table_name)
+        stage = fingerprint(fetched, self.geography, self.staging_format)
+        if stage == last.get("stage") and file_stat(staged_path) == last.get("staged"):
+            self.task(table_name, "stage", "skipped")
+        else:
+            changed = sorted(line_code for line_code in data_dict if line_code in self.api.changed_keys) or sorted(data_dict)
+            await loop.run_in_executor(None, self.bea_clean.state_filter, data_dict, table_name, changed)
+            self.task(table_name, "stage", "done", start)
+        del data_dict
+        staged = file_stat(staged_path)
+
+        inputs = self.load_inputs(code, table_name, staged)
+        if inputs == last.get("inputs") and await self.write(self.table_fingerprint, table_name) == last.get("table"):
+            self.task(table_name, "transform", "skipped")
+            self.task(table_name, "load", "skipped")
+            return 0
+
+        step["name"] = "transform"
+        start = time.perf_counter()
+        _, path, seconds, worker_rss, pid = await loop.run_in_executor(self.transformer, prep.transform_worker, table_name, self.output_path)
+        try:
+            data = feather.read_table(path, memory_map=True)
+            metrics.observe("bea_transform_seconds", seconds, table=table_name)
+            self.task(table_name, "transform", "done", start, rows=data.num_rows, worker=pid, worker_peak_rss_mb=round(worker_rss, 1))
+
+            step["name"] = "load"
+            start = time.perf_counter()
+            try:
+                rows, table = await self.write(self.load_table, table_name, data)
+            except bea_quality_error as e:
+                self.rejected[table_name] = e.report["tables"][table_name]
+                self.task(table_name, "load", "rejected", start, error=str(e))
+                return None
+            finally:
+                del data
+        finally:
+            os.remove(path)
+        self.task(table_name, "load", "done", start, rows_merged=rows)
+        self.loaded.add(table_name)
+        self.state["tables"][table_name] = {"stage": stage, "staged": staged, "inputs": inputs, "table": table}
+        self.save_state()
+        return rows
+
+    def refresh_view(self, view_name, loaded):
+        """
+        Create a view missing or of the wrong kind, or all of them after the aliases changed.
+        Materialized ones otherwise recompute the partitions their tables merged. Returns whether anything ran.
+        """
+        if self.aliases_changed or self.views.object_type(view_name) != ("table" if self.materialize else "view"):
+            if self.materialize:
+                self.views.create_table(view_name)
+            else:
+                self.views.create_view(view_name)
+            return True
+        if self.materialize and loaded:
+            self.views.refresh_table(view_name)
+            return True
+        return False
+
+    async def run_view(self, view_name, table_tasks):
+        sources, _ = self.views.view_sources[view_name]
+        sources = set(sources) | {entry["source_table"] for entry in self.aliases.values() if entry["table"] in sources}
+        waits = {table_name: table_tasks[table_name] for table_name in sorted(sources) if table_name in table_tasks}
+        if not waits:
+            return
+        loaded = dict(zip(waits, await asyncio.gather(*waits.values())))
+        failed = [table_name for table_name, rows in loaded.items() if rows is None]
+        if failed:
+            self.task(view_name, "view", "blocked", tables=failed)
+            return
+        start = time.perf_counter()
+        refreshed = await self.write(self.refresh_view, view_name, any(loaded.values()))
+        self.task(view_name, "view", "done" if refreshed else "skipped", start if refreshed else None)
+
+    def finish_run(self):
+        """
+        Cube and export of whatever merged this run, then the combined quality report. load_changes is only cleared
+        here, after every view has read it.
+        """
+        changes = self.changed_partitions(self.con)
+        with metrics.stage("cube"):
+            bea_cube(self.con).refresh(sorted(changes))
+        with metrics.stage("export", export_format=self.export_format):
+            self.export(self.con, changes)
+        self.con.execute("delete from load_changes")
+        self.con.close()
+        self.publish()
+
+    async def schedule(self):
+        loop = asyncio.get_running_loop()
+        self.api.start()
+        await loop.run_in_executor(None, self.api.linecode_lookup)
+        self.aliases = self.api.series_aliases()
+        self.con = await self.write(self.connect)
+        try:
+            self.views = beav.bea_views(self.con, self.materialize)
+            async with aiohttp.ClientSession() as session:
+                table_tasks = {TABLE_NAMES[code]: asyncio.create_task(self.run_table(code, session)) for code in self.tables}
+                view_tasks = [asyncio.create_task(self.run_view(view_name, table_tasks)) for view_name in self.views.view_sources]
+                await asyncio.gather(*table_tasks.values(), *view_tasks)
+            with metrics.stage("finish"):
+                await self.write(self.finish_run)
+        except BaseException:
+            # finish_run closes the connection itself, closing again is a no-op
+            await self.write(self.discard_run)
+            raise
+
+    def discard_run(self):
+        """
+        Close the connection and drop the swap copy after a fatal error, leaving db_path as it was
+        """
+        self.con.close()
+        self.publish(commit=False)
+
+    def run(self):
+        """
+        Run the graph for the selected tables. Tables that fetched and passed their checks stay loaded, exported and recorded
+        when others fail, then bea_quality_error, bea_incomplete_error or a RuntimeError naming the failed steps is raised.
+        """
+        cache = bea_cache(self.cache_path) if self.cache_path else None
+        # series shared across tables are fetched for the first one in the whole registry, whichever tables run
+        self.api = self.bea_clean.api(self.key, cache)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        self.transformer = ProcessPoolExecutor(max_workers=max(1, min(len(self.tables), cores)), initializer=prep.init_worker,
+                                               initargs=(self.staging_format, DATA_PATH, self.batch_size))
+        shared_memory = self.batch_size is None and os.path.isdir("/dev/shm")
+        self.output_path = tempfile.mkdtemp(prefix="bea_transform_", dir="/dev/shm" if shared_memory else DATA_PATH)
+        try:
+            with metrics.stage("pipeline", tables=len(self.tables)):
+                asyncio.run(self.schedule())
+        finally:
+            self.transformer.shutdown()
+            self.writer.shutdown()
+            shutil.rmtree(self.output_path, ignore_errors=True)
+            if cache is not None:
+                cache.close()
+        metrics.gauge("bea_transform_worker_peak_rss_mb", peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+        report = {"passed": not self.rejected, "tables": {**self.reports, **self.rejected}}
+        if self.quality_report is not None and report["tables"]:
+            with open(self.quality_report, "w") as outfile:
+                json.dump(report, outfile, indent=2)
+        self.bea_clean.aliases = self.aliases
+        # the tables loaded here are done, the staged files of rejected ones wait for the next load
+        self.bea_clean.write_manifests(consumed=self.loaded)
+        if self.rejected:
+            raise bea_quality_error(report)
+        if self.api.failed:
+            raise bea_incomplete_error(sorted(self.api.failed))
+        if self.errors:
+            raise RuntimeError("Tables failed: " + ", ".join(f"{table_name} ({error})" for table_name, error in sorted(self.errors.items())))
+        self.bea_clean.finish_checkpoint()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract and load BEA tables as a per table task graph, skipping up to date steps")
+    parser.add_argument("--tables", nargs="+", help="BEA codes or table names to refresh, all tables by default")
+    parser.add_argument("--force", action="store_true", help="run every step, ignoring the fingerprints of the last run")
+    parser.add_argument("--state-path", default=STATE_PATH, help="where to keep the fingerprints of the last successful run")
+    parser.add_argument("--incremental", action="store_true", help="only request years after the last cached period")
+    parser.add_argument("--revision-window", type=int, default=3, help="trailing cached years to re-request on incremental runs")
+    parser.add_argument("--no-cache", action="store_true", help="download everything without the response cache")
+    parser.add_argument("--staging-format", choices=("parquet", "feather", "json"), default="parquet")
+    parser.add_argument("--export-format", choices=("parquet", "csv", "none"), default="parquet")
+    parser.add_argument("--materialize", action="store_true", help="store analysis views as incrementally refreshed tables")
+    parser.add_argument("--geography", choices=("STATE", "COUNTY"), default="STATE", help="COUNTY adds county rows for the CA* tables")
+    parser.add_argument("--batch-size", type=int, help="transform and merge this many rows at a time, for county data")
+    parser.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 4GB. Larger loads spill to disk")
+    parser.add_argument("--resume", action="store_true", help="continue the last unfinished run, retrying only failed or missing line codes")
+    parser.add_argument("--full-export", action="store_true", help="rewrite every Parquet partition, not only the changed ones")
+    parser.add_argument("--quality-report", default=QUALITY_REPORT_PATH, help="where to write the data quality report")
+    parser.add_argument("--swap", action="store_true", help="load into a copy of the database and swap it in, for a running bea_query.py")
+    parser.add_argument("--log-file", help="append JSON logs to this file instead of stdout")
+    parser.add_argument("--metrics-file", help="write run metrics in the Prometheus text format to this file")
+    args = parser.parse_args()
+    metrics.configure(args.log_file)
+
+    key = os.environ.get("BEA_KEY")
+    try:
+        pipeline = bea_pipeline(key, args.tables, None if args.no_cache else CACHE_PATH, args.incremental, args.revision_window, args.staging_format,
+                                args.export_format, args.materialize, geography=args.geography, batch_size=args.batch_size,
+                                memory_limit=args.memory_limit, resume=args.resume, quality_report=args.quality_report, swap=args.swap,
+                                full_export=args.full_export, state_path=args.state_path, force=args.force)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        pipeline.run()
+    except bea_incomplete_error as e:
+        metrics.event("run_incomplete", failed=[code for code, _ in e.failed], hint="rerun with --resume to retry only these")
+        raise SystemExit(1)
+    except bea_quality_error as e:
+        metrics.event("load_rejected", error=str(e), report=args.quality_report)
+        raise SystemExit(1)
+    finally:
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
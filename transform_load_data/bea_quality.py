@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data"))
+from bea_metrics import metrics
+
+RULES_PATH = "inputs/quality_rules.json"
+GEOGRAPHY_LEVELS = {"state": "geofips like '%000'", "county": "geofips not like '%000'", "all": "true"}
+
+
+class bea_quality_error(Exception):
+    """
+    Raised when a loaded table fails a rule of error severity. report holds every check of the run.
+    """
+    def __init__(self, report):
+        failed = [f"{table}: {check['check']}" for table, result in report["tables"].items()
+                  for check in result["checks"] if not check["passed"] and check["severity"] == "error"]
+        super().__init__(f"{len(failed)} data quality checks failed: " + ", ".join(failed[:10]))
+        self.report = report
+
+
+class bea_quality():
+    """
+    Declarative data quality rules for the loaded tables, read from inputs/quality_rules.json.
+    not_null, unique, geography (distinct geofips + geonames), range and year_coverage (per series) rules each compile to
+    an aggregate per code, rolled up into table measures, so a table is scanned once however many rules it has.
+    All tables run as one UNION ALL query, which DuckDB executes across its threads inside the load's transaction.
+    A rule applies to every table unless it lists "tables", and fails the load unless its severity is warn.
+    """
+    def __init__(self, con, rules_path=RULES_PATH):
+        """
+        con = DuckDB connection with the loaded tables
+        rules_path = JSON list of rules
+        """
+        self.con = con
+        with open(rules_path, "r") as f:
+            self.rules = json.load(f)
+
+    def table_rules(self, table):
+        return [rule for rule in self.rules if table in rule.get("tables", (table,))]
+
+    def compile_rule(self, rule):
+        """
+        Checks of one rule as (check, aggregate per code, table measure, window, bounds).
+        The table measure and window refer to the per code column as {m} and the window column as {w}.
+        """
+        max_rows = {"max": rule.get("max_rows", 0)}
+        if rule["rule"] == "not_null":
+            return [(f"not_null.{column}", f'count(*) filter (where "{column}" is null)', "sum({m})", None, max_rows)
+                    for column in rule["columns"]]
+        if rule["rule"] == "unique":
+            # duplicates can only share a code, so they are counted within each code
+            if "code" not in rule["columns"]:
+                raise ValueError(f"unique rules need code among their columns, got {rule['columns']}")
+            columns = ", ".join(f'"{column}"' for column in rule["columns"] if column != "code") or "1"
+            return [(f"unique.{','.join(rule['columns'])}", f"count(*) - count(distinct ({columns}))", "sum({m})", None, max_rows)]
+        if rule["rule"] == "geography":
+            level = rule.get("level", "all")
+            bounds = {key: rule[key] for key in ("min", "max") if key in rule}
+            return [(f"geography.{level}.{column}", f"list(distinct {column}) filter (where {GEOGRAPHY_LEVELS[level]})",
+                     "len(list_distinct(flatten(list({m}))))", None, bounds) for column in ("geofips", "geoname")]
+        if rule["rule"] == "range":
+            column = rule["column"]
+            outside = []
+            if "min" in rule:
+                outside.append(f'"{column}" < {rule["min"]}')
+            if "max" in rule:
+                outside.append(f'"{column}" > {rule["max"]}')
+            return [(f"range.{column}", f'count(*) filter (where isfinite("{column}") and ({" or ".join(outside)}))', "sum({m})", None, max_rows)]
+        if rule["rule"] == "year_coverage":
+            # series missing years inside their span, and series ending before the table's latest year
+            return [("year_coverage.gaps", "max(timeperiod) - min(timeperiod) + 1 - count(distinct timeperiod)",
+                     "count(*) filter (where {m} > 0)", None, {"max": rule.get("max_gaps", 0)}),
+                    ("year_coverage.behind", "max(timeperiod)",
+                     "count(*) filter (where {m} < {w})", "max({m}) over ()", {"max": rule.get("max_behind", 0)})]
+        raise ValueError(f"Unknown data quality rule {rule['rule']}")
+
+    def compile_table(self, table):
+        """
+        ([(check, severity, bounds)], query) for every rule of a table. The query returns the table's measures as one JSON row.
+        """
+        checks, series, windows, measures = [], ["count(*) as series_rows"], [], ["'rows': sum(series_rows)"]
+        for rule in self.table_rules(table):
+            for name, per_code, measure, window, bounds in self.compile_rule(rule):
+                m, w = f"m{len(checks)}", f"w{len(checks)}"
+                series.append(f"{per_code} as {m}")
+                if window is not None:
+                    windows.append(f"{window.format(m=m)} as {w}")
+                measures.append(f"'{name}': {measure.format(m=m, w=w)}")
+                checks.append((name, rule.get("severity", "error"), bounds))
+        query = f"""
+            select '{table}' as table_name, to_json({{{", ".join(measures)}}}) as measures
+            from (
+                select *{"".join(", " + window for window in windows)}
+                from (
+                    select {", ".join(series)}
+                    from {table}
+                    left join series using (code)
+                    left join geography using (geofips)
+                    group by code))
+                 """
+        return checks, query
+
+    def run(self, tables):
+        """
+        Check every rule of tables in one query. Returns the report with each check's value and pass/fail,
+        per table and overall (failed error checks only).
+        """
+        start = time.perf_counter()
+        compiled = {table: self.compile_table(table) for table in tables}
+        values = {}
+        if compiled:
+            query = " union all ".join(query for _, query in compiled.values())
+            values = {table: json.loads(measures) for table, measures in self.con.execute(query).fetchall()}
+        report = {"checked_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "passed": True, "tables": {}}
+        for table, (checks, _) in compiled.items():
+            result = {"passed": True, "rows": values[table]["rows"] or 0, "checks": []}
+            for name, severity, bounds in checks:
+                value = values[table][name] or 0
+                passed = bounds.get("min", value) <= value <= bounds.get("max", value)
+                result["checks"].append({"check": name, "value": value, **bounds, "severity": severity, "passed": passed})
+                if not passed:
+                    metrics.inc("bea_quality_failures_total", table=table, check=name, severity=severity)
+                    if severity == "error":
+                        result["passed"] = report["passed"] = False
+            failed = [check["check"] for check in result["checks"] if not check["passed"]]
+            metrics.event("validated", table=table, passed=result["passed"], rows=result["rows"], checks=len(checks), failed=failed)
+            report["tables"][table] = result
+        report["seconds"] = round(time.perf_counter() - start, 4)
+        return report
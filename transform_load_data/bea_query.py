@@ -0,0 +1,314 @@
+import os
+import sys
+import time
+import collections
+import asyncio
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb as db
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data"))
+from bea_metrics import metrics
+from bea_views import fact_source
+
+# analysis views with a change ranking: (category column, value column, change column)
+RANKINGS = {"consumer_expenditures": ("consumer_expenditure", "spend", "spend_change"),
+            "income": ("income_type", "income", "income_change")}
+
+
+def literal(value):
+    # EXECUTE takes literals, not bound parameters
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(int(value))
+
+
+class query_pool():
+    """
+    Read-only cursors over one version of the database file, each with every lookup prepared once.
+    A retired pool closes when its last borrowed cursor comes back.
+    """
+    def __init__(self, db_path, size, version):
+        self.version = version
+        # attached to a fresh in-memory database, since db.connect() would hand back the instance already open on this path
+        self.con = db.connect()
+        self.con.execute(f"attach {literal(db_path)} as bea (read_only)")
+        self.con.execute("use bea")
+        self.tables = tuple(sorted(table for (table,) in self.con.execute("select table_name from duckdb_columns where column_name = 'datavalue'").fetchall()))
+        views = {view for (view,) in self.con.execute("select view_name from duckdb_views").fetchall()}
+        views |= {table for (table,) in self.con.execute("select table_name from duckdb_tables").fetchall()}
+        self.rankings = tuple(view for view in RANKINGS if view in views)
+        # with the series other tables hold for them (series_alias)
+        self.sources = {table: fact_source(self.con, table) for table in self.tables}
+        self.idle = []
+        self.waiters = collections.deque()
+        self.lock = threading.Lock()
+        self.borrowed = 0
+        self.retired = False
+        for _ in range(size):
+            cursor = self.con.cursor()
+            cursor.execute("use bea")
+            self.prepare(cursor)
+            self.idle.append(cursor)
+
+    def prepare(self, cursor):
+        for table in self.tables:
+            cursor.execute(f"""
+                prepare series_{table} as
+                select code, timeperiod as year, datavalue as value, cl_unit as unit, unit_mult
+                from {self.sources[table]}
+                where geoname = $1 and topic = $2 and timeperiod between $3 and $4
+                order by code, year
+                           """)
+            cursor.execute(f"""
+                prepare yoy_{table} as
+                select code, year, value, prev_value, value - prev_value as change, round(100 * (value - prev_value) / prev_value, 2) as change_pct
+                from (
+                    select code, timeperiod as year, datavalue as value,
+                        lag(datavalue) over (partition by code order by timeperiod) as prev_value
+                    from {self.sources[table]}
+                    where geoname = $1 and topic = $2 and timeperiod between $3 - 1 and $4)
+                where year between $3 and $4
+                order by code, year
+                           """)
+            cursor.execute(f"""
+                prepare topics_{table} as
+                select distinct topic
+                from {self.sources[table]}
+                order by 1
+                           """)
+        for view in self.rankings:
+            category, value, change = RANKINGS[view]
+            cursor.execute(f"""
+                prepare ranking_{view} as
+                select state, {value} as value, {change} as change, change_rank as rank
+                from {view}
+                where year = $1 and {category} = $2
+                order by change_rank, state
+                limit $3
+                           """)
+        cursor.execute("prepare states as select geoname from geography where geofips like '%000' order by geofips")
+
+    def borrow(self):
+        """
+        A cursor, waiting in line for one to be free. None once the pool is retired.
+        """
+        with self.lock:
+            if self.retired:
+                return None
+            self.borrowed += 1
+            if self.idle:
+                return self.idle.pop()
+            waiter = [threading.Event(), None]
+            self.waiters.append(waiter)
+        waiter[0].wait()
+        return waiter[1]
+
+    def give_back(self, cursor):
+        # handed straight to the longest waiting borrower, so a busy thread can't take it back first
+        with self.lock:
+            self.borrowed -= 1
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                waiter[1] = cursor
+                waiter[0].set()
+            else:
+                self.idle.append(cursor)
+            close = self.retired and self.borrowed == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            close = self.borrowed == 0
+        if close:
+            self.close()
+
+    def close(self):
+        for cursor in self.idle:
+            cursor.close()
+        self.con.close()
+
+
+class bea_query():
+    """
+    Read API over the database built by db_load: series, year over year changes and change rankings by state,
+    topic and year. Lookups run as prepared statements on a pool of read-only cursors, and results are kept in an LRU cache.
+    A finished load replaces the database file (db_load swap=True). The next lookup notices, opens a pool on the new file and
+    starts a new cache generation. invalidate() does the same in process.
+    """
+    def __init__(self, db_path="bureau_economic_analysis.db", pool_size=4, cache_size=4096, check_interval=1.0):
+        """
+        db_path = DuckDB database file written by db_load
+        pool_size = read-only cursors, i.e. lookups running at once
+        cache_size = lookup results kept, 0 to disable the cache
+        check_interval = seconds between checks of the database file for a new load
+        """
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked_at = 0.0
+        self.generation = 0
+        self.pool = query_pool(db_path, pool_size, self.version())
+        self.cached = lru_cache(maxsize=cache_size)(self.execute)
+
+    def version(self):
+        stat = os.stat(self.db_path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def invalidate(self):
+        """
+        Reopen the database and drop cached results, e.g. after a load in this process
+        """
+        with self.lock:
+            old, self.pool = self.pool, query_pool(self.db_path, self.pool_size, self.version())
+            self.generation += 1
+            self.checked_at = time.monotonic()
+        old.retire()
+        self.cached.cache_clear()
+        metrics.inc("bea_query_invalidations_total")
+        metrics.event("query_cache_invalidated", database=self.db_path, generation=self.generation)
+
+    def check(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        if self.version() != self.pool.version:
+            self.invalidate()
+
+    def execute(self, generation, statement, params):
+        """
+        (columns, rows) of one prepared statement. Cached per generation, so a result never outlives its load.
+        """
+        with self.cursor() as cursor:
+            arguments = f"({', '.join(literal(param) for param in params)})" if params else ""
+            result = cursor.execute(f"execute {statement}{arguments}")
+            return tuple(column[0] for column in result.description), tuple(result.fetchall())
+
+    @contextmanager
+    def cursor(self):
+        # a pool retired by invalidate() hands out no more cursors, take one from its replacement
+        cursor = None
+        while cursor is None:
+            pool = self.pool
+            cursor = pool.borrow()
+        try:
+            yield cursor
+        finally:
+            pool.give_back(cursor)
+
+    def lookup(self, statement, *params):
+        start = time.perf_counter()
+        self.check()
+        columns, rows = self.cached(self.generation, statement, params)
+        metrics.observe("bea_query_seconds", time.perf_counter() - start, statement=statement.split("_")[0])
+        return [dict(zip(columns, row)) for row in rows]
+
+    def table(self, table):
+        if table not in self.pool.tables:
+            raise ValueError(f"Unknown table {table}, expected one of {self.pool.tables}")
+        return table
+
+    def states(self):
+        return [row["geoname"] for row in self.lookup("states")]
+
+    def topics(self, table):
+        return [row["topic"] for row in self.lookup(f"topics_{self.table(table)}")]
+
+    def series(self, table, state, topic, start_year=0, end_year=9999):
+        """
+        [{code, year, value, unit, unit_mult}] of one topic in one state. value is in units of 10 ** unit_mult.
+        """
+        return self.lookup(f"series_{self.table(table)}", state, topic, start_year, end_year)
+
+    def yoy(self, table, state, topic, start_year=0, end_year=9999):
+        """
+        [{code, year, value, prev_value, change, change_pct}], change_pct against the previous year
+        """
+        return self.lookup(f"yoy_{self.table(table)}", state, topic, start_year, end_year)
+
+    def ranking(self, view, year, category, limit=10):
+        """
+        States of an analysis view ranked by change for one year + category, e.g. ranking("income", 2020, "personal income")
+        """
+        if view not in self.pool.rankings:
+            raise ValueError(f"Unknown ranking {view}, expected one of {self.pool.rankings}")
+        return self.lookup(f"ranking_{view}", year, category, limit)
+
+    def stats(self):
+        info = self.cached.cache_info()
+        return {"generation": self.generation, "cache_hits": info.hits, "cache_misses": info.misses, "cache_size": info.currsize}
+
+    def close(self):
+        self.pool.retire()
+
+
+class bea_query_server():
+    """
+    JSON over HTTP for bea_query. Lookups run on a thread per pooled cursor so the event loop keeps accepting requests.
+    GET /series, /yoy ?table=&state=&topic=[&start_year=&end_year=], /ranking ?view=&year=&category=[&limit=],
+    /topics ?table=, /states and /stats
+    """
+    def __init__(self, query):
+        self.query = query
+        self.executor = ThreadPoolExecutor(max_workers=query.pool_size)
+
+    async def run(self, lookup):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, lookup)
+        except (KeyError, ValueError) as e:
+            return web.json_response({"error": f"bad request: {e}"}, status=400)
+        return web.json_response(result)
+
+    def years(self, q):
+        return int(q.get("start_year", 0)), int(q.get("end_year", 9999))
+
+    async def series(self, request):
+        q = request.query
+        return await self.run(lambda: self.query.series(q["table"], q["state"], q["topic"], *self.years(q)))
+
+    async def yoy(self, request):
+        q = request.query
+        return await self.run(lambda: self.query.yoy(q["table"], q["state"], q["topic"], *self.years(q)))
+
+    async def ranking(self, request):
+        q = request.query
+        return await self.run(lambda: self.query.ranking(q["view"], int(q["year"]), q["category"], int(q.get("limit", 10))))
+
+    async def topics(self, request):
+        return await self.run(lambda: self.query.topics(request.query["table"]))
+
+    async def states(self, request):
+        return await self.run(self.query.states)
+
+    async def stats(self, request):
+        return web.json_response(self.query.stats())
+
+    def app(self):
+        app = web.Application()
+        for route in ("series", "yoy", "ranking", "topics", "states", "stats"):
+            app.router.add_get(f"/{route}", getattr(self, route))
+        return app
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve read-only lookups over the DuckDB database")
+    parser.add_argument("--db-path", default="bureau_economic_analysis.db")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--pool-size", type=int, default=4, help="read-only cursors, i.e. lookups running at once")
+    parser.add_argument("--cache-size", type=int, default=4096, help="lookup results kept in the LRU cache")
+    parser.add_argument("--log-file", help="append JSON logs to this file instead of stdout")
+    args = parser.parse_args()
+    metrics.configure(args.log_file)
+
+    query = bea_query(args.db_path, args.pool_size, args.cache_size)
+    web.run_app(bea_query_server(query).app(), host="127.0.0.1", port=args.port, print=None)
@@ -0,0 +1,123 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from bea_db_load import db_load, QUALITY_REPORT_PATH
+from bea_quality import bea_quality_error
+from bea_async import bea_incomplete_error
+from bea_cache import bea_cache, CACHE_PATH
+from bea_data_json import bea_data_clean
+from bea_metrics import metrics
+
+
+class bea_stream(db_load):
+    """
+    Single process extract -> load without staging files. Each line code response is filtered to states,
+    joined to its endpoint + topic and appended to its DuckDB table as soon as it lands.
+    Loads run on one writer thread while the event loop keeps fetching, and only responses in flight are held in memory.
+    The two stage bea_data_json.py -> bea_db_load.py run is still available for debugging.
+    """
+    def __init__(self, key, cache_path=CACHE_PATH, incremental=False, revision_window=3, export_format="parquet", materialize=False,
+                 db_path="bureau_economic_analysis.db", geography="STATE", memory_limit=None, resume=False, quality_report=QUALITY_REPORT_PATH,
+                 swap=False, full_export=False):
+        """
+        key = BEA api key
+        cache_path, incremental, revision_window, geography, resume = see bea_data_clean. Unchanged line codes are not reloaded.
+        export_format, materialize, db_path, memory_limit, quality_report, swap, full_export = see db_load
+        """
+        super().__init__(export_format=export_format, materialize=materialize, db_path=db_path, memory_limit=memory_limit,
+                         quality_report=quality_report, swap=swap, full_export=full_export)
+        self.key = key
+        self.cache_path = cache_path
+        self.bea_clean = bea_data_clean(cache_path, incremental, revision_window, geography=geography, resume=resume)
+        self.loader = ThreadPoolExecutor(max_workers=1)
+        self.loaded = {}
+
+    def load_batch(self, table_name, code, df):
+        """
+        Merge one line code's new or revised rows into its table
+        """
+        start = time.perf_counter()
+        df = self.bea_clean.filter_states(df, table_name)
+        batch = self.bea_prep.clean_table(table_name, self.bea_prep.bea_table(self.bea_prep.staging.to_arrow(df)))
+        rows = self.upsert(self.con, table_name, batch)
+        self.loaded[table_name] = self.loaded.get(table_name, 0) + rows
+        seconds = time.perf_counter() - start
+        metrics.observe("bea_load_seconds", seconds, table=table_name)
+        metrics.inc("bea_load_rows_total", rows, table=table_name)
+        metrics.event("loaded", table=table_name, code=code, rows_in=batch.num_rows, rows_merged=rows, seconds=round(seconds, 4))
+
+    async def on_result(self, table, code, df, changed):
+        table_name = self.async_api.table_names[table]
+        if not changed and code in self.existing.get(table_name, ()):
+            return
+        await asyncio.get_running_loop().run_in_executor(self.loader, self.load_batch, table_name, code, df)
+
+    def duckdb(self):
+        # create DuckDB database
+        self.con = self.connect()
+        # merged line codes are already committed, any failure (bea_incomplete_error for --resume, a failed check)
+        # stops before the views and export and discards a swap copy
+        try:
+            tables = set(self.con.sql("select table_name from duckdb_columns where column_name = 'code'").df()["table_name"])
+            self.existing = {table_name: set(self.con.sql(f"select distinct code from {table_name}").df()["code"]) for table_name in tables}
+
+            # line codes merged before a failure stay merged, --resume only requests the rest
+            cache = bea_cache(self.cache_path) if self.cache_path else None
+            self.async_api = self.bea_clean.api(self.key, cache)
+            try:
+                self.async_api.stream_data(self.on_result)
+            finally:
+                self.loader.shutdown()
+                if cache is not None:
+                    cache.close()
+
+            for table_name, rows in self.loaded.items():
+                metrics.event("streamed", table=table_name, rows_merged=rows, database=self.db_path)
+            aliases_changed = self.upsert_aliases(self.con, self.async_api.series_aliases())
+            self.validate(self.con, list(self.loaded))
+        except BaseException:
+            self.con.close()
+            self.publish(commit=False)
+            raise
+
+        self.finish(self.con, [table_name for table_name, rows in self.loaded.items() if rows > 0], aliases_changed)
+        self.bea_clean.finish_checkpoint()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Stream BEA data straight into DuckDB")
+    parser.add_argument("--incremental", action="store_true", help="only request years after the last cached period")
+    parser.add_argument("--revision-window", type=int, default=3, help="trailing cached years to re-request on incremental runs")
+    parser.add_argument("--no-cache", action="store_true", help="download everything without the response cache")
+    parser.add_argument("--export-format", choices=("parquet", "csv", "none"), default="parquet")
+    parser.add_argument("--materialize", action="store_true", help="store analysis views as incrementally refreshed tables")
+    parser.add_argument("--geography", choices=("STATE", "COUNTY"), default="STATE", help="COUNTY adds county rows for the CA* tables")
+    parser.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 4GB. Larger loads spill to disk")
+    parser.add_argument("--resume", action="store_true", help="continue the last unfinished run, retrying only failed or missing line codes")
+    parser.add_argument("--full-export", action="store_true", help="rewrite every Parquet partition, not only the changed ones")
+    parser.add_argument("--quality-report", default=QUALITY_REPORT_PATH, help="where to write the data quality report")
+    parser.add_argument("--swap", action="store_true", help="load into a copy of the database and swap it in, for a running bea_query.py")
+    parser.add_argument("--log-file", help="append JSON logs to this file instead of stdout")
+    parser.add_argument("--metrics-file", help="write run metrics in the Prometheus text format to this file")
+    args = parser.parse_args()
+    metrics.configure(args.log_file)
+
+    key = os.environ.get("BEA_KEY")
+    try:
+        with metrics.stage("stream"):
+            stream = bea_stream(key, None if args.no_cache else CACHE_PATH, args.incremental, args.revision_window, args.export_format, args.materialize,
+                                geography=args.geography, memory_limit=args.memory_limit, resume=args.resume, quality_report=args.quality_report, swap=args.swap,
+                                full_export=args.full_export)
+            stream.duckdb()
+    except bea_incomplete_error as e:
+        metrics.event("run_incomplete", failed=[code for code, _ in e.failed], hint="rerun with --resume to retry only these")
+        raise SystemExit(1)
+    except bea_quality_error as e:
+        metrics.event("load_rejected", error=str(e), report=args.quality_report)
+        raise SystemExit(1)
+    finally:
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
@@ -1,15 +1,69 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_data"))
+from bea_metrics import metrics
+
+
+def alias_sources(con, table):
+    """
+    Tables holding series that table has aliases for, see db_load.upsert_aliases
+    """
+    if con.execute("select count(*) from duckdb_tables where table_name = 'series_alias'").fetchone()[0] == 0:
+        return []
+    return [source for (source,) in con.execute(
+        "select distinct source_table from series_alias where table_name = ? order by 1", [table]).fetchall()]
+
+
+def fact_source(con, table):
+    """
+    A fact table with the geoname, topic and units of its geography and series dimension tables, under the table's own name.
+    Series it shares with another table are stored once, there, and read back under the table's own alias codes.
+    """
+    facts = [f"select * from {table}"]
+    for source in alias_sources(con, table):
+        facts.append(f"""select series_alias.code, {source}.* exclude (code)
+            from {source}
+            join series_alias on series_alias.alias_of = {source}.code
+            where series_alias.table_name = '{table}'""")
+    return f"""(
+            select facts.*, geography.geoname, series.topic, series.cl_unit, series.unit_mult
+            from ({" union all by name ".join(facts)}) facts
+            join series using (code)
+            join geography using (geofips)) as {table}"""
+
+
 class bea_views():
-    def __init__(self, con):
+    def __init__(self, con, materialize=False):
+        """
+        con = DuckDB connection
+        materialize = store the analysis views as tables, refreshed incrementally from the rows the last load changed
+        """
         self.con = con
+        self.materialize = materialize
+        # source tables, and whether window functions rank across states (year) or stay within a state (state_year)
+        self.view_sources = {"consumer_expenditures": (("consumption_expenditures",), "year"),
+                             "income": (("disposable_income", "employment"), "year"),
+                             "employment_population": (("wages_salary",), "state_year"),
+                             "industry_compensation": (("compensation",), "state_year")}
+        self.view_queries = {"consumer_expenditures": self.consumer_expenditure_query,
+                             "income": self.income_query,
+                             "employment_population": self.employment_query,
+                             "industry_compensation": self.compensation_query}
+        self.view_order = {"consumer_expenditures": "year, consumer_expenditure, state",
+                           "income": "year, income_type, state",
+                           "employment_population": "state, year",
+                           "industry_compensation": "state, year"}
+
+    def source(self, table):
+        return fact_source(self.con, table)
 
-    def create_consumer_expenditure_view(self):
-        ce_topics = ("Per capita personal consumption expenditures: Nondurable goods", 
-                    "Per capita personal consumption expenditures: Durable goods", 
+    def consumer_expenditure_query(self, input_filter="true"):
+        ce_topics = ("Per capita personal consumption expenditures: Nondurable goods",
+                    "Per capita personal consumption expenditures: Durable goods",
                     "Per capita personal consumption expenditures: Services",
                     "Per capita personal consumption expenditures: Housing and utilities")
-        query = f""" 
-        create or replace view consumer_expenditures as 
-
+        query = f"""
         with expenditures as (
 
         select
@@ -17,19 +71,23 @@ class bea_views():
             timeperiod as year,
             datavalue as spend,
             lag(datavalue, 1) over (partition by geoname, topic order by timeperiod asc) as prev_year_spend,
-            round(100 * (datavalue - lag(datavalue, 1) over (partition by geoname, topic order by timeperiod asc)) / datavalue, 2) as spend_change,
-            case 
+            case
                 when topic like '%Nondurable%' then 'nondurable goods'
                 when topic like '%Durable%' then 'durable goods'
                 when topic like '%Services%' then 'services'
                 when topic like '%Housing%' then 'housing'
             end as consumer_expenditure
-        from consumption_expenditures
+        from {self.source('consumption_expenditures')}
         where topic in {ce_topics}
-            and timeperiod >= '2000'
-        order by timeperiod,
-            topic,
-            geoname)
+            and timeperiod >= 2000
+            and {input_filter}),
+
+        expenditure_change as (
+
+        select
+            *,
+            round(100 * (spend - prev_year_spend) / spend, 2) as spend_change
+        from expenditures)
 
         select
             state,
@@ -39,18 +97,12 @@ class bea_views():
             spend_change,
             dense_rank() over (partition by year, consumer_expenditure order by spend_change desc) as change_rank,
             consumer_expenditure
-        from expenditures
-        order by year,
-            consumer_expenditure,
-            state
+        from expenditure_change
                 """
-        self.con.execute(query)
-        print("Created Consumer Expenditures view")
-
-    def create_income_view(self):
-        query = f""" 
-        create or replace view income as
+        return query
 
+    def income_query(self, input_filter="true"):
+        query = f"""
         with all_income as (
 
         select
@@ -58,40 +110,43 @@ class bea_views():
             timeperiod as year,
             datavalue as income,
             topic
-        from disposable_income
+        from {self.source('disposable_income')}
         where topic = 'Per capita disposable personal income'
             and timeperiod >= 2000
+            and {input_filter}
 
-        union
+        union all
 
         select
             geoname as state,
             timeperiod as year,
             datavalue as income,
             topic
-        from employment
+        from {self.source('employment')}
         where topic = 'Per capita personal income'
+            and geofips like '%000'
             and timeperiod >= 2000
-        order by timeperiod,
-            topic,
-            geoname),
+            and {input_filter}),
 
-        income_change as (
+        prev_income as (
 
         select
             state,
             year,
             income,
             lag(income, 1) over (partition by state, topic order by year asc) as prev_year_income,
-            round(100 * (income - lag(income, 1) over (partition by state, topic order by year asc)) / income, 2) as income_change,
             case
                 when topic like '%disposable%' then 'disposable income'
                 when topic like '%personal%' then 'personal income'
             end as income_type
-        from all_income
-        order by year,
-            topic,
-            state)
+        from all_income),
+
+        income_change as (
+
+        select
+            *,
+            round(100 * (income - prev_year_income) / income, 2) as income_change
+        from prev_income)
 
         select
             state,
@@ -102,79 +157,146 @@ class bea_views():
             dense_rank() over (partition by year, income_type order by income_change desc) as change_rank,
             income_type
         from income_change
-        order by year,
-            income_type,
-            state
                 """
-        self.con.execute(query)
-        print("Created Income view")
-
-    def create_employment_view(self):
-        query = f""" 
-        create or replace view employment_population as
+        return query
 
+    def employment_query(self, input_filter="true"):
+        # one pass over wages_salary, pivoting employment + population instead of joining the table to itself.
+        # County (CA*) tables may also hold county rows, the views stay at US + state level
+        query = f"""
         select
-            employment.geoname as state,
-            employment.timeperiod as year,
-            employment.datavalue as employment,
-            population.datavalue as population,
-            employment.topic
-        from wages_salary employment
-        inner join wages_salary population on employment.geoname = population.geoname and employment.timeperiod = population.timeperiod
-        where employment.topic = 'Total employment'
-            and employment.timeperiod >= 2000
-            and population.topic = 'Population'
-        order by state,
-            year
+            geoname as state,
+            timeperiod as year,
+            max(datavalue) filter (where topic = 'Total employment') as employment,
+            max(datavalue) filter (where topic = 'Population') as population,
+            'Total employment' as topic
+        from {self.source('wages_salary')}
+        where topic in ('Total employment', 'Population')
+            and geofips like '%000'
+            and timeperiod >= 2000
+            and {input_filter}
+        group by geoname, timeperiod
+        having count(*) filter (where topic = 'Total employment') > 0
+            and count(*) filter (where topic = 'Population') > 0
                 """
-        self.con.execute(query)
-        print("Created employment view")
+        return query
 
-    def create_compensation_view(self):
+    def compensation_query(self, input_filter="true"):
+        # the top industry per state + year comes from one window instead of joining a ranked copy of the table
         industries_to_remove = ("All industry total", "Private services-providing industries", "Private industries")
-        query = f""" 
-        create or replace view industry_compensation as
-
-        with compensation_ranked as (
-            select
-                geoname as state,
-                timeperiod as year,
-                datavalue as compensation,
-                topic as industry,
-                dense_rank() over (partition by state, year order by datavalue desc) as compensation_rank
-            from compensation 
-            where geoname != 'United States'
-                and topic not in {industries_to_remove})
-
+        query = f"""
         select
-            comp.geoname as state,
-            comp.timeperiod as year,
-            comp.datavalue as compensation,
-            comp.topic as industry,
-            ranked.industry as top_industry
-        from compensation comp
-        inner join compensation_ranked ranked on comp.geoname = ranked.state and comp.timeperiod = ranked.year
-        where comp.geoname != 'United States'
+            geoname as state,
+            timeperiod as year,
+            datavalue as compensation,
+            topic as industry,
+            arg_max(topic, datavalue) over (partition by geoname, timeperiod) as top_industry
+        from {self.source('compensation')}
+        where geoname != 'United States'
             and topic not in {industries_to_remove}
-            and ranked.compensation_rank = 1
-        order by 
-            comp.geoname, 
-            comp.timeperiod
+            and {input_filter}
                 """
+        return query
+
+    def create_view(self, view_name):
+        if self.object_type(view_name) == "table":
+            self.con.execute(f"drop table {view_name}")
+        query = f"create or replace view {view_name} as {self.view_queries[view_name]()} order by {self.view_order[view_name]}"
         self.con.execute(query)
-        print("Created compensation view")
+        metrics.event("view_created", view=view_name)
 
-    def views_exist(self):
-        db_views = set(self.con.sql("select view_name from duckdb_views").df()["view_name"].to_list())
-        create_view = {"income": self.create_income_view,
-                       "employment_population": self.create_employment_view, 
-                       "consumer_expenditures": self.create_consumer_expenditure_view, 
-                       "industry_compensation": self.create_compensation_view}
+    def create_table(self, view_name):
+        if self.object_type(view_name) == "view":
+            self.con.execute(f"drop view {view_name}")
+        self.con.execute(f"create or replace table {view_name} as {self.view_queries[view_name]()}")
+        self.mark_refreshed(view_name, "full")
+        metrics.event("view_materialized", view=view_name)
+
+    def object_type(self, name):
+        if name in self.existing("duckdb_views", "view_name"):
+            return "view"
+        if name in self.existing("duckdb_tables", "table_name"):
+            return "table"
+        return None
+
+    def existing(self, catalog, column):
+        return set(self.con.sql(f"select {column} from {catalog}").df()[column].to_list())
 
-        views_needed = set(list(create_view.keys()))
-        views_to_create = tuple(db_views ^ views_needed)
+    def mark_refreshed(self, view_name, refresh_type):
+        self.con.execute("""
+            create table if not exists view_refresh (
+                view_name varchar primary key,
+                refreshed_at timestamp,
+                refresh_type varchar)
+                         """)
+        self.con.execute("insert or replace into view_refresh values (?, now(), ?)", [view_name, refresh_type])
+
+    def refresh_table(self, view_name):
+        """
+        Recompute only the partitions touched by the last load, from the load_changes rows written by db_load.upsert.
+        Views ranking across states recompute whole years; lag() also reaches into the following year.
+        """
+        sources, partition = self.view_sources[view_name]
+        sources = sources + tuple(source for table in sources for source in alias_sources(self.con, table))
+        table_list = ", ".join(f"'{table}'" for table in sources)
+        changes = f"""select distinct geography.geoname as state, load_changes.timeperiod as year
+            from load_changes join geography using (geofips) where table_name in ({table_list})"""
+        if partition == "year":
+            years = sorted({year for (year,) in self.con.execute(f"select distinct year from ({changes})").fetchall()})
+            if not years:
+                return
+            years = sorted(set(years) | {year + 1 for year in years})
+            year_list = ", ".join(str(year) for year in years)
+            input_years = ", ".join(str(year) for year in sorted(set(years) | {year - 1 for year in years}))
+            input_filter = f"timeperiod in ({input_years})"
+            output_filter = f"year in ({year_list})"
+        else:
+            if self.con.execute(f"select count(*) from ({changes})").fetchone()[0] == 0:
+                return
+            input_filter = f"(geoname, timeperiod) in (select (state, year) from ({changes}))"
+            output_filter = "true"
+        refreshed = f"select * from ({self.view_queries[view_name](input_filter)}) where {output_filter}"
+        self.con.begin()
+        self.con.execute(f"create or replace temp table refreshed as {refreshed}")
+        if partition == "year":
+            self.con.execute(f"delete from {view_name} where {output_filter}")
+        else:
+            self.con.execute(f"delete from {view_name} where (state, year) in (select (state, year) from ({changes}))")
+        self.con.execute(f"insert into {view_name} select * from refreshed")
+        rows = self.con.execute("select count(*) from refreshed").fetchone()[0]
+        self.con.execute("drop table refreshed")
+        self.mark_refreshed(view_name, "incremental")
+        self.con.commit()
+        metrics.event("view_refreshed", view=view_name, rows=rows)
+
+    def views_exist(self):
+        db_views = self.existing("duckdb_views", "view_name")
+        views_needed = set(self.view_queries)
+        views_to_create = tuple(views_needed - db_views)
 
         if len(views_to_create) > 0:
-            print("Need to create views for:", views_to_create)
-            for topic in views_to_create:
-                create_view[topic]()
+            for view_name in views_to_create:
+                self.create_view(view_name)
+
+    def refresh(self, rebuild=False):
+        """
+        Plain views are created once. Materialized views are built in full the first time,
+        then only the partitions changed by the last load are recomputed.
+        rebuild = recreate every view in full, e.g. after series_alias changed the tables they read
+        """
+        if rebuild:
+            for view_name in self.view_queries:
+                if self.materialize:
+                    self.create_table(view_name)
+                else:
+                    self.create_view(view_name)
+        elif not self.materialize:
+            self.views_exist()
+        else:
+            db_tables = self.existing("duckdb_tables", "table_name")
+            for view_name in self.view_queries:
+                if view_name in db_tables:
+                    self.refresh_table(view_name)
+                else:
+                    self.create_table(view_name)
+        self.con.execute("delete from load_changes")
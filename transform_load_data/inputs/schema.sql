@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS geography(geofips VARCHAR PRIMARY KEY, geoname VARCHAR NOT NULL);
+CREATE TABLE IF NOT EXISTS series(code VARCHAR PRIMARY KEY, "table" VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, topic VARCHAR NOT NULL, cl_unit VARCHAR, unit_mult SMALLINT);
+CREATE TABLE IF NOT EXISTS series_alias(code VARCHAR PRIMARY KEY, table_name VARCHAR NOT NULL, alias_of VARCHAR NOT NULL, source_table VARCHAR NOT NULL);
+CREATE TABLE IF NOT EXISTS compensation(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS consumption_expenditures(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS disposable_income(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS employment(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS gdp(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS personal_income(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS population(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS real_gdp(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS wages_salary(code VARCHAR NOT NULL, geofips VARCHAR NOT NULL, timeperiod INTEGER NOT NULL, datavalue DOUBLE, noteref VARCHAR, PRIMARY KEY (code, geofips, timeperiod));
+CREATE TABLE IF NOT EXISTS load_changes(table_name VARCHAR, geofips VARCHAR, timeperiod INTEGER);